@@ -1,27 +1,170 @@
 import streamlit as st
-import pandas as pd
-import google.generativeai as genai
 import datetime
-import PIL.Image
 import json
 import re
 import time
+import threading
+from collections import deque, OrderedDict
+from collections.abc import MutableMapping
 import io
 import gzip
+import codecs
+import csv
+import struct
+import zipfile
 import base64
 import random
+import os
+import hashlib
+import functools
+import importlib
+import importlib.util
+import sys
+import sqlite3
+import difflib
+import unicodedata
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait, Future, FIRST_COMPLETED
 
-# 音声生成用ライブラリ
-try:
-    from gtts import gTTS
-except ImportError:
-    gTTS = None
+class LazyModule:
+    # 属性に初めて触れた時に import する。起動直後の最初の表示では読み込まない重いモジュール用
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+
+    def __getattr__(self, attr):
+        if self._module is None: self._module = importlib.import_module(self._name)
+        return getattr(self._module, attr)
+
+def module_available(name):
+    # 読み込まずに入っているかだけ調べる
+    return name in sys.modules or importlib.util.find_spec(name) is not None
+
+pd = LazyModule("pandas")
+np = LazyModule("numpy")
+genai = LazyModule("google.generativeai")
+Image = LazyModule("PIL.Image")
+ImageOps = LazyModule("PIL.ImageOps")
+gtts = LazyModule("gtts")   # 音声生成用ライブラリ (無くても動く)
 
 # ==========================================
 # 🔐 初期設定
 # ==========================================
 st.set_page_config(page_title="新潟高校 合格ナビ", layout="wide", page_icon="🏔️")
 
+# --------------------------------------------------------------------------------
+# 🩺 計測 (スパン)
+# --------------------------------------------------------------------------------
+# JUKEN_DIAGNOSTICS=1 の時だけ記録し、サイドバーに診断パネルを出す。無効時は何もしない共通オブジェクトを返すだけ。
+# JUKEN_SPAN_LOG にパスを指定すると、全セッションのスパンを JSON Lines で追記する (集計用)
+DIAGNOSTICS = os.environ.get("JUKEN_DIAGNOSTICS", "") not in ("", "0")
+SPAN_LOG_PATH = os.environ.get("JUKEN_SPAN_LOG")
+
+class NullSpan:
+    def __enter__(self): return self
+    def __exit__(self, *exc): return False
+    def set(self, **fields): pass
+
+NULL_SPAN = NullSpan()
+
+class Span:
+    __slots__ = ('tracer', 'name', 'fields', 'start')
+
+    def __init__(self, tracer, name, fields):
+        self.tracer, self.name, self.fields = tracer, name, fields
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def set(self, **fields):
+        self.fields.update(fields)
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type: self.fields['error'] = exc_type.__name__
+        self.tracer.record(self.name, time.perf_counter() - self.start, self.fields)
+        return False
+
+class Tracer:
+    # プロセス全体で共有。記録にはその時の再実行ID (スレッドごと) を付け、バックグラウンドの処理は run=None になる
+    def __init__(self, enabled, log_path=None, maxlen=5000):
+        self.enabled = enabled
+        self._records = deque(maxlen=maxlen)
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._log = open(log_path, 'a', encoding='utf-8') if enabled and log_path else None
+
+    def span(self, name, **fields):
+        if not self.enabled: return NULL_SPAN
+        return Span(self, name, fields)
+
+    def begin_run(self, run_id):
+        self._local.run = run_id
+
+    def record(self, name, seconds, fields):
+        rec = {'ts': round(time.time(), 3), 'run': getattr(self._local, 'run', None), 'span': name, 'ms': round(seconds * 1000, 2), **fields}
+        with self._lock:
+            self._records.append(rec)
+            if self._log:
+                self._log.write(json.dumps(rec, ensure_ascii=False, default=str) + "\n")
+                self._log.flush()
+
+    def records(self, run=None):
+        with self._lock: return [r for r in self._records if run is None or r['run'] == run]
+
+    def summary(self):
+        # スパン名ごとの件数・時間・再試行・トークン数
+        df = pd.DataFrame(self.records())
+        if df.empty: return df
+        for c in ['attempts', 'prompt_tokens', 'response_tokens']:
+            if c not in df.columns: df[c] = np.nan
+        g = df.groupby('span')
+        out = g['ms'].agg(['count', 'sum', 'mean', 'max']).rename(columns={'count': '件数', 'sum': '合計ms', 'mean': '平均ms', 'max': '最大ms'})
+        out['p90ms'] = g['ms'].quantile(0.9)
+        out['再試行'] = (g['attempts'].sum() - g['attempts'].count()).astype(int)
+        out['入力トークン'] = g['prompt_tokens'].sum().astype(int)
+        out['出力トークン'] = g['response_tokens'].sum().astype(int)
+        return out.round(1).sort_values('合計ms', ascending=False).reset_index()
+
+@st.cache_resource(show_spinner=False)
+def get_tracer():
+    return Tracer(DIAGNOSTICS, SPAN_LOG_PATH)
+
+tracer = get_tracer()
+run_started = time.perf_counter()
+if tracer.enabled:
+    if 'diag_session' not in st.session_state: st.session_state['diag_session'] = f"{random.getrandbits(32):08x}"
+    st.session_state['diag_run'] = st.session_state.get('diag_run', 0) + 1
+    tracer.begin_run(f"{st.session_state['diag_session']}:{st.session_state['diag_run']}")
+
+class LatencyLog:
+    # 直近の計測値をプロセス全体で保持する (最初の文字が表示されるまでの時間など)
+    def __init__(self, maxlen=500):
+        self._samples = deque(maxlen=maxlen)
+        self._lock = threading.Lock()
+
+    def add(self, site, seconds):
+        with self._lock: self._samples.append((site, seconds))
+
+    def summary(self, site=None):
+        with self._lock: values = sorted(v for s, v in self._samples if site is None or s == site)
+        if not values: return None
+        return {'count': len(values), 'avg': sum(values) / len(values), 'p90': values[min(len(values) - 1, int(len(values) * 0.9))]}
+
+def traced_fragment(name):
+    # st.fragment に計測用のスパンを付ける。操作した部分だけの再実行にかかった時間が診断パネルに出る
+    def wrap(fn):
+        @functools.wraps(fn)
+        def run(*args, **kwargs):
+            with tracer.span(f"fragment:{name}"): return fn(*args, **kwargs)
+        return st.fragment(run)
+    return wrap
+
+def usage_tokens(resp):
+    # Gemini の usage_metadata からトークン数を取り出す (無い場合は空)
+    usage = getattr(resp, 'usage_metadata', None)
+    if not usage: return {}
+    return {'prompt_tokens': getattr(usage, 'prompt_token_count', 0) or 0, 'response_tokens': getattr(usage, 'candidates_token_count', 0) or 0}
+
 # --------------------------------------------------------------------------------
 # 🎨 UIデザイン & CSS
 # --------------------------------------------------------------------------------
@@ -30,7 +173,8 @@ today = datetime.date.today()
 days_left = (exam_date - today).days
 if days_left < 0: days_left = 0
 
-st.markdown(f"""
+with tracer.span("css"):
+    st.markdown(f"""
 <style>
     @import url('https://fonts.googleapis.com/css2?family=Noto+Sans+JP:wght@400;500;700&display=swap');
     
@@ -132,18 +276,13 @@ if not api_key:
     st.warning("⚠️ SecretsにAPIキーが設定されていません。")
     st.stop()
 
-genai.configure(api_key=api_key)
-
 # ---------------------------------------------------------
 # 🤖 モデル設定
 # ---------------------------------------------------------
-def get_available_models():
-    try:
-        return [m.name.replace("models/", "") for m in genai.list_models()]
-    except:
-        return []
-
-ALL_MODELS = get_available_models()
+MODEL_LIST_TTL = 60 * 60   # モデル一覧の有効期限(秒)
+MODEL_LIST_RETRY = 60      # 一覧取得に失敗した時の再試行間隔(秒)
+# list_models() が失敗した時に使う固定スナップショット
+FALLBACK_MODELS = ["gemini-2.5-pro", "gemini-2.5-flash", "gemini-2.0-flash", "gemini-1.5-pro", "gemini-1.5-flash"]
 
 def get_best_pro_model(all_models):
     priority_list = [
@@ -168,38 +307,412 @@ def get_best_flash_model(all_models):
         if m in all_models: return m
     return get_best_pro_model(all_models)
 
-MODEL_NAME_PRO = get_best_pro_model(ALL_MODELS)
-MODEL_NAME_FLASH = get_best_flash_model(ALL_MODELS)
-try:
-    model_pro = genai.GenerativeModel(MODEL_NAME_PRO)
-    model_flash = genai.GenerativeModel(MODEL_NAME_FLASH)
-    model_vision = genai.GenerativeModel(MODEL_NAME_PRO)
-except: pass
+class ModelRegistry:
+    # プロセス全体で共有するモデル一覧とモデルオブジェクト。
+    # 一覧はTTL付きで保持し、期限切れ後は古い一覧を返しつつバックグラウンドで更新する。
+    # モデルオブジェクトは初めて使われた時に作る。
+    def __init__(self, api_key, ttl=MODEL_LIST_TTL):
+        self.api_key = api_key
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._init_lock = threading.Lock()
+        self._configure_lock = threading.Lock()
+        self._configured = False
+        self._names = None
+        self._expires = 0.0
+        self._refreshing = False
+        self._models = {}
+
+    def _genai(self):
+        # google.generativeai の読み込みと設定は、初めて使う時 (普通は表示後の warm_up) に1回だけ
+        if not self._configured:
+            with self._configure_lock:
+                if not self._configured:
+                    genai.configure(api_key=self.api_key)
+                    self._configured = True
+        return genai
+
+    def _fetch(self):
+        with tracer.span("model_list") as sp:
+            try: names = [m.name.replace("models/", "") for m in self._genai().list_models()]
+            except: names = []
+            sp.set(models=len(names))
+        with self._lock:
+            if names:
+                self._names = names
+                self._expires = time.time() + self.ttl
+            else:
+                if self._names is None: self._names = list(FALLBACK_MODELS)
+                self._expires = time.time() + MODEL_LIST_RETRY
+            self._refreshing = False
+
+    def _refresh_async(self):
+        with self._lock:
+            if self._refreshing: return
+            self._refreshing = True
+        threading.Thread(target=self._fetch, daemon=True).start()
+
+    def names(self):
+        if self._names is None:
+            with self._init_lock:
+                if self._names is None: self._fetch()
+        elif time.time() >= self._expires:
+            self._refresh_async()
+        return self._names
+
+    def model_name(self, role):
+        # role: "pro" / "flash" / "vision" (visionはProと同じモデル)
+        if role == "flash": return get_best_flash_model(self.names())
+        return get_best_pro_model(self.names())
+
+    def model(self, role):
+        key = (role, self.model_name(role))
+        m = self._models.get(key)
+        if m is None:
+            with self._lock:
+                m = self._models.get(key)
+                if m is None: m = self._models[key] = self._genai().GenerativeModel(key[1])
+        return m
+
+@st.cache_resource(show_spinner=False)
+def get_model_registry(api_key):
+    return ModelRegistry(api_key)
+
+model_registry = get_model_registry(api_key)
+
+# 起動を速くするため、重いモジュールの読み込みとモデル一覧の取得は最初の画面を描いた後に裏で済ませる
+WARM_UP = os.environ.get("JUKEN_WARM_UP", "1") != "0"
+WARM_UP_MODULES = ["pandas", "google.generativeai", "PIL.Image", "PIL.ImageOps", "gtts", "matplotlib.figure"]
+
+@st.cache_resource(show_spinner=False)
+def start_warm_up():
+    # プロセスで1回だけ。間に合わなかった分は使う時にその場で読み込まれる
+    def run():
+        with tracer.span("warm_up") as sp:
+            for name in WARM_UP_MODULES:
+                try: importlib.import_module(name)
+                except ImportError: pass
+            sp.set(models=len(model_registry.names()))
+    thread = threading.Thread(target=run, daemon=True, name="warm-up")
+    thread.start()
+    return thread
 
 # ---------------------------------------------------------
 # 💾 データ管理
 # ---------------------------------------------------------
 if 'data_store' not in st.session_state: st.session_state['data_store'] = {}
-if 'clean_df' not in st.session_state: st.session_state['clean_df'] = pd.DataFrame()
+# 増分解析用: data_store のキー(ファイル名+内容のハッシュ)ごとの整形済みデータと、分類できなかった単元
+if 'clean_parts' not in st.session_state: st.session_state['clean_parts'] = {}
+if 'unresolved_pairs' not in st.session_state: st.session_state['unresolved_pairs'] = []
 if 'category_map' not in st.session_state: st.session_state['category_map'] = {}
 if 'textbooks' not in st.session_state: st.session_state['textbooks'] = {}
 
 # 特訓モード用
 if 'practice_data' not in st.session_state: st.session_state['practice_data'] = {} 
 
-def compress_data_to_code(data_dict):
-    try:
-        json_str = json.dumps(data_dict, ensure_ascii=False, default=str)
-        compressed = gzip.compress(json_str.encode('utf-8'))
-        return base64.b64encode(compressed).decode('utf-8')
-    except: return None
-
+# 旧形式 (JSON→gzip→base64) のバックアップは復元のみ対応
 def decompress_code_to_data(b64_str):
     try:
         compressed = base64.b64decode(b64_str)
         return json.loads(gzip.decompress(compressed).decode('utf-8'))
     except: return None
 
+# ---------------------------------------------------------
+# 📦 バックアップ形式 (列指向バイナリ)
+# ---------------------------------------------------------
+# ファイル構成: MAGIC + 形式バージョン(1byte) + gzipストリーム
+# gzipの中身はレコードの列: タグ(1byte) + 長さ(uint32) + 本体
+#   H: ヘッダJSON (種別・ID・ベースID・参考書・カテゴリ対応表・削除されたキー)
+#   F: data_store の1エントリ (列ごとに型付きで格納。文字列列は辞書+コード配列)
+#   E: 終端
+BACKUP_MAGIC = b"NGBK"
+BACKUP_VERSION = 1
+
+class BackupError(Exception):
+    pass
+
+def _pack_record(tag, payload):
+    return tag + struct.pack('<I', len(payload)) + payload
+
+def _read_exact(fp, n):
+    data = fp.read(n)
+    if len(data) != n: raise BackupError("バックアップが途中で切れています")
+    return data
+
+def encode_column(col):
+    if pd.api.types.is_bool_dtype(col) and not col.isna().any(): return b'b', col.to_numpy(np.uint8).tobytes()
+    if pd.api.types.is_integer_dtype(col) and not col.isna().any(): return b'i', col.to_numpy('<i8').tobytes()
+    if pd.api.types.is_float_dtype(col): return b'f', col.to_numpy('<f8').tobytes()
+    codes, uniques = pd.factorize(col, use_na_sentinel=True)
+    width = 1 if len(uniques) < 0xff else 2 if len(uniques) < 0xffff else 4
+    vocab = json.dumps([v.item() if isinstance(v, np.generic) else v for v in uniques], ensure_ascii=False, default=str).encode('utf-8')
+    # コード0は欠損値
+    return b's', struct.pack('<BI', width, len(vocab)) + vocab + (codes + 1).astype(f'<u{width}').tobytes()
+
+def decode_column(kind, data):
+    if kind == b'b': return np.frombuffer(data, np.uint8).astype(bool)
+    if kind == b'i': return np.frombuffer(data, '<i8')
+    if kind == b'f': return np.frombuffer(data, '<f8')
+    if kind == b's':
+        width, vlen = struct.unpack_from('<BI', data)
+        vocab = np.array([np.nan] + json.loads(data[5:5 + vlen].decode('utf-8')), dtype=object)
+        return vocab[np.frombuffer(data, f'<u{width}', offset=5 + vlen)]
+    raise BackupError(f"未対応の列形式: {kind!r}")
+
+def encode_frame(key, df):
+    cols = [encode_column(df[c]) for c in df.columns]
+    index = encode_column(pd.Series(df.index)) if pd.api.types.is_integer_dtype(df.index) else None
+    meta = json.dumps({'key': key, 'columns': [str(c) for c in df.columns], 'index': index is not None}, ensure_ascii=False).encode('utf-8')
+    parts = [struct.pack('<I', len(meta)), meta]
+    for kind, data in cols + ([index] if index else []):
+        parts += [kind, struct.pack('<I', len(data)), data]
+    return b''.join(parts)
+
+def decode_frame(payload):
+    (mlen,) = struct.unpack_from('<I', payload)
+    meta = json.loads(payload[4:4 + mlen].decode('utf-8'))
+    pos = 4 + mlen
+    arrays = []
+    for _ in range(len(meta['columns']) + (1 if meta['index'] else 0)):
+        kind = payload[pos:pos + 1]
+        (n,) = struct.unpack_from('<I', payload, pos + 1)
+        arrays.append(decode_column(kind, payload[pos + 5:pos + 5 + n]))
+        pos += 5 + n
+    index = arrays.pop() if meta['index'] else None
+    return meta['key'], pd.DataFrame(dict(zip(meta['columns'], arrays)), index=index, columns=meta['columns'])
+
+def write_backup(fp, header, frames):
+    # frames は (キー, df) のイテレータ。1件ずつ圧縮しながら書き出す
+    fp.write(BACKUP_MAGIC + bytes([BACKUP_VERSION]))
+    with gzip.GzipFile(fileobj=fp, mode='wb') as gz:
+        gz.write(_pack_record(b'H', json.dumps(header, ensure_ascii=False, default=str).encode('utf-8')))
+        for key, df in frames: gz.write(_pack_record(b'F', encode_frame(key, df)))
+        gz.write(_pack_record(b'E', b''))
+
+def read_backup(fp):
+    # ('header', dict) → ('frame', (キー, df)) ... の順に1件ずつ返す
+    if _read_exact(fp, len(BACKUP_MAGIC)) != BACKUP_MAGIC: raise BackupError("バックアップ形式ではありません")
+    version = _read_exact(fp, 1)[0]
+    if version > BACKUP_VERSION: raise BackupError(f"新しい形式(v{version})のため読めません")
+    with gzip.GzipFile(fileobj=fp, mode='rb') as gz:
+        while True:
+            tag = _read_exact(gz, 1)
+            (n,) = struct.unpack('<I', _read_exact(gz, 4))
+            payload = _read_exact(gz, n)
+            if tag == b'E': return
+            if tag == b'H': yield 'header', json.loads(payload.decode('utf-8'))
+            elif tag == b'F': yield 'frame', decode_frame(payload)
+
+def make_backup(kind='full'):
+    # kind='delta' は直近の完全バックアップ(ベース)以降に増えたファイルだけを書き出す
+    store = st.session_state['data_store']
+    base = st.session_state.get('backup_base') if kind == 'delta' else None
+    snap_id = hashlib.sha256(f"{time.time()}:{sorted(store)}".encode()).hexdigest()[:12]
+    header = {
+        'kind': kind, 'id': snap_id, 'base': base['id'] if base else None,
+        'created': datetime.datetime.now().isoformat(timespec='seconds'),
+        'textbooks': st.session_state['textbooks'],
+        'category_map': {f"{k[0]}:{k[1]}" if isinstance(k, tuple) else str(k): v for k, v in st.session_state['category_map'].items()},
+        'removed': [k for k in base['keys'] if k not in store] if base else [],
+    }
+    keys = [k for k in store if not base or k not in base['keys']]
+    buf = io.BytesIO()
+    write_backup(buf, header, ((k, store[k]) for k in keys))
+    if kind == 'full': st.session_state['backup_base'] = {'id': snap_id, 'keys': set(store)}
+    suffix = f"_diff_{base['id']}" if base else ""
+    return {'data': buf.getvalue(), 'file_name': f"niigata_bk_{today}{suffix}.ngb", 'kind': kind, 'files': len(keys), 'version': st.session_state.get('data_version', 0)}
+
+def load_backup(raw):
+    # バイナリ / そのbase64 / 旧形式 のいずれかを読み、共通の辞書にする
+    if not raw.startswith(BACKUP_MAGIC):
+        try: decoded = base64.b64decode(raw.strip())
+        except Exception: decoded = b""
+        if decoded.startswith(BACKUP_MAGIC): raw = decoded
+        else:
+            data = decompress_code_to_data(raw.decode('utf-8', errors='ignore').strip())
+            if not data: raise BackupError("バックアップとして読めません")
+            return {'kind': 'full', 'id': None, 'base': None, 'created': '', 'removed': [],
+                    'textbooks': data.get('textbooks', {}), 'category_map': data.get('category_map', {}),
+                    'data_store': {n: pd.read_json(io.StringIO(j), orient='split') for n, j in data.get('data_store', {}).items()}}
+    snap = {'data_store': {}}
+    for kind, item in read_backup(io.BytesIO(raw)):
+        if kind == 'header': snap.update(item)
+        else: snap['data_store'][item[0]] = item[1]
+    return snap
+
+def restore_backups(blobs):
+    # 完全バックアップ1つ + (任意で)その差分バックアップ。差分は累積なので一番新しいものだけ使う
+    snaps = [load_backup(b) for b in blobs]
+    fulls = [s for s in snaps if s['kind'] == 'full']
+    deltas = sorted([s for s in snaps if s['kind'] == 'delta'], key=lambda s: s['created'])
+    if len(fulls) != 1: raise BackupError("完全バックアップを1つだけ選んでください")
+    full = fulls[0]
+    store = dict(full['data_store'])
+    latest = full
+    if deltas:
+        delta = deltas[-1]
+        if delta['base'] != full['id']: raise BackupError("差分バックアップのベースが一致しません")
+        for key in delta['removed']: store.pop(key, None)
+        store.update(delta['data_store'])
+        latest = delta
+    store = {k: compact_frame(df) for k, df in store.items()}
+    st.session_state['textbooks'] = latest.get('textbooks', {})
+    st.session_state['category_map'] = {(k.split(':',1)[0], k.split(':',1)[1]) if ':' in k else (k,k): v for k, v in latest.get('category_map', {}).items()}
+    st.session_state['data_store'] = store
+    st.session_state['backup_base'] = {'id': full['id'], 'keys': set(full['data_store'])} if full['id'] else None
+    st.session_state.pop('backup_blob', None)
+    reset_analysis()
+
+# ---------------------------------------------------------
+# 👤 生徒データの保存 (サーバー側・任意)
+# ---------------------------------------------------------
+# JUKEN_STUDENT_DB にSQLiteのパスを指定した時だけ有効。生徒IDごとに data_store を1ファイル1行で保存し、
+# 中身は使われた時に1ファイルずつ読む。単元→カテゴリの対応表は全生徒で共有する。
+# 認証はなく、生徒IDを入力するだけで誰のデータでも開けて上書きもできる。信頼できるネットワーク内 (家庭・教室) 専用
+STUDENT_DB_PATH = os.environ.get("JUKEN_STUDENT_DB")
+
+class StudentStore:
+    def __init__(self, path):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute("CREATE TABLE IF NOT EXISTS students (id TEXT PRIMARY KEY, textbooks TEXT, updated REAL)")
+        self._db.execute("CREATE TABLE IF NOT EXISTS frames (student TEXT, key TEXT, name TEXT, data BLOB, updated REAL, PRIMARY KEY (student, key))")
+        self._db.execute("CREATE TABLE IF NOT EXISTS category_map (subject TEXT, topic TEXT, category TEXT, PRIMARY KEY (subject, topic))")
+        self._db.commit()
+
+    def _query(self, sql, args=()):
+        with self._lock: return self._db.execute(sql, args).fetchall()
+
+    def _write(self, sql, rows):
+        with self._lock:
+            self._db.executemany(sql, rows)
+            self._db.commit()
+
+    def exists(self, student):
+        return bool(self._query("SELECT 1 FROM students WHERE id=?", (student,)))
+
+    def create(self, student):
+        self._write("INSERT OR IGNORE INTO students VALUES (?, '{}', ?)", [(student, time.time())])
+
+    def frame_names(self, student):
+        # {キー: ファイル名} (保存順)。中身は読まない
+        return dict(self._query("SELECT key, name FROM frames WHERE student=? ORDER BY updated, key", (student,)))
+
+    def load_frame(self, student, key):
+        rows = self._query("SELECT data FROM frames WHERE student=? AND key=?", (student, key))
+        if not rows: raise KeyError(key)
+        return compact_frame(decode_frame(gzip.decompress(rows[0][0]))[1])
+
+    def save_frames(self, student, frames):
+        now = time.time()
+        self._write("INSERT OR REPLACE INTO frames VALUES (?,?,?,?,?)",
+                    [(student, k, store_entry_name(df), gzip.compress(encode_frame(k, df)), now) for k, df in frames.items()])
+
+    def delete_frames(self, student, keys):
+        self._write("DELETE FROM frames WHERE student=? AND key=?", [(student, k) for k in keys])
+
+    def textbooks(self, student):
+        rows = self._query("SELECT textbooks FROM students WHERE id=?", (student,))
+        return json.loads(rows[0][0] or "{}") if rows else {}
+
+    def save_textbooks(self, student, textbooks):
+        self._write("UPDATE students SET textbooks=?, updated=? WHERE id=?", [(json.dumps(textbooks, ensure_ascii=False), time.time(), student)])
+
+    def category_map(self):
+        return {(s, t): c for s, t, c in self._query("SELECT subject, topic, category FROM category_map")}
+
+    def save_category_map(self, mapping):
+        self._write("INSERT OR REPLACE INTO category_map VALUES (?,?,?)", [(s, t, c) for (s, t), c in mapping.items()])
+
+class LazyFrames(MutableMapping):
+    # ログイン中の data_store。キーとファイル名の一覧だけ先に持ち、中身は初めて使われた時にDBから読む
+    def __init__(self, store, student, names):
+        self.store, self.student = store, student
+        self._frames = dict.fromkeys(names)
+        self._names = dict(names)
+
+    def __getitem__(self, key):
+        df = self._frames[key]
+        if df is None: df = self._frames[key] = self.store.load_frame(self.student, key)
+        return df
+
+    def __setitem__(self, key, df):
+        self._frames[key] = df
+        self._names[key] = store_entry_name(df)
+
+    def __delitem__(self, key):
+        del self._frames[key]
+        del self._names[key]
+
+    def __iter__(self): return iter(self._frames)
+    def __len__(self): return len(self._frames)
+    def __contains__(self, key): return key in self._frames   # 中身を読まずに判定する
+
+    def loaded(self):
+        return [df for df in self._frames.values() if df is not None]
+
+    def names(self):
+        return dict(self._names)
+
+@st.cache_resource(show_spinner=False)
+def get_student_store():
+    if not STUDENT_DB_PATH: return None
+    try: return StudentStore(STUDENT_DB_PATH)
+    except: return None
+
+student_store = get_student_store()
+
+# 共有の対応表はセッション開始時に取り込む。student_sync は前回DBに書いた時点の状態
+if student_store and 'student_sync' not in st.session_state:
+    shared_map = student_store.category_map()
+    st.session_state['category_map'].update(shared_map)
+    st.session_state['student_sync'] = {'cmap': set(shared_map), 'keys': set(), 'textbooks': None}
+
+def sync_student_store():
+    # 前回の同期から変わった分だけ書く (ファイルの追加・削除、参考書、新しく分類できた単元)
+    if not student_store: return
+    sync = st.session_state['student_sync']
+    cmap = st.session_state['category_map']
+    learned = {k: v for k, v in cmap.items() if isinstance(k, tuple) and k not in sync['cmap']}
+    if learned:
+        student_store.save_category_map(learned)
+        sync['cmap'].update(learned)
+    student = st.session_state.get('student_id')
+    if not student: return
+    store = st.session_state['data_store']
+    added = [k for k in store if k not in sync['keys']]
+    removed = [k for k in sync['keys'] if k not in store]
+    if added: student_store.save_frames(student, {k: store[k] for k in added})
+    if removed: student_store.delete_frames(student, removed)
+    sync['keys'] = set(store)
+    if st.session_state['textbooks'] != sync['textbooks']:
+        student_store.save_textbooks(student, st.session_state['textbooks'])
+        sync['textbooks'] = dict(st.session_state['textbooks'])
+
+def switch_student(student):
+    # 新しいIDなら今のセッションのデータをそのIDで保存し、既存のIDならそのデータに切り替える
+    sync_student_store()
+    sync = st.session_state['student_sync']
+    if student and student_store.exists(student):
+        keys = student_store.frame_names(student)
+        st.session_state['data_store'] = LazyFrames(student_store, student, keys)
+        st.session_state['textbooks'] = student_store.textbooks(student)
+        sync['keys'], sync['textbooks'] = set(keys), dict(st.session_state['textbooks'])
+        st.session_state['practice_data'] = {}
+        st.session_state['backup_base'] = None
+        st.session_state.pop('backup_blob', None)
+        reset_analysis()
+    elif student:
+        student_store.create(student)
+        sync['keys'], sync['textbooks'] = set(), None
+    else:
+        st.session_state['data_store'] = {}
+        st.session_state['textbooks'] = {}
+        st.session_state['practice_data'] = {}
+        reset_analysis()
+    st.session_state['student_id'] = student
+
 FIXED_CATEGORIES = {
     "国語": ["漢字", "文法", "評論", "古文", "その他"],
     "数学": ["正負の数・文字と式", "一次方程式・連立方程式", "平方根", "式の展開と因数分解", "二次方程式", "比例・反比例", "一次関数", "関数y=ax^2", "平面図形（作図・移動・おうぎ形）", "空間図形", "図形の性質と証明（合同・相似・円）", "確率・統計（データの活用・三平方の定理）", "融合問題", "その他"],
@@ -209,112 +722,981 @@ FIXED_CATEGORIES = {
 }
 
 # ---------------------------------------------------------
-# 🛠️ 関数定義
+# 🗄️ AI応答キャッシュ
 # ---------------------------------------------------------
-def ask_gemini_robust(prompt, image_list=None, use_flash=False):
-    max_retries = 3
-    if image_list: target_model = model_vision
-    elif use_flash: target_model = model_flash
-    else: target_model = model_pro
-    for attempt in range(max_retries):
+CACHE_DIR = os.environ.get("JUKEN_CACHE_DIR", ".juken_cache")
+RESPONSE_CACHE_MAX_BYTES = 64 * 1024 * 1024
+# ヒット時の最終アクセス時刻はメモリに溜め、この件数か秒数を超えたら (または容量整理の前に) まとめて書く
+RESPONSE_CACHE_TOUCH_BATCH = 64
+RESPONSE_CACHE_TOUCH_SECONDS = 30
+# 呼び出し元ごとの有効期限(秒)。ランダム出題などキャッシュしない呼び出しは cache_site=None
+CACHE_TTL = {
+    "default": 24 * 3600,
+    "classify": 90 * 24 * 3600,   # 単元分類
+    "advice": 7 * 24 * 3600,      # アドバイス
+    "grade": 30 * 24 * 3600,      # 画像採点・添削
+}
+
+def normalize_prompt(prompt):
+    # インデントや改行の違いだけのプロンプトを同一視する
+    return re.sub(r'\s+', ' ', str(prompt)).strip()
+
+def image_digest(img):
+    if isinstance(img, dict): img = img['data']   # 前処理済みの画像 {'mime_type', 'data'}
+    if isinstance(img, (bytes, bytearray)): return hashlib.sha256(img).hexdigest()
+    h = hashlib.sha256(f"{img.mode}:{img.size}:".encode())
+    h.update(img.tobytes())
+    return h.hexdigest()
+
+def make_cache_key(model_name, prompt, image_list=None, schema=None):
+    h = hashlib.sha256(model_name.encode('utf-8'))
+    h.update(b"\0" + normalize_prompt(prompt).encode('utf-8'))
+    for img in image_list or []: h.update(b"\0" + image_digest(img).encode())
+    if schema: h.update(b"\0" + json.dumps(schema, sort_keys=True, ensure_ascii=False).encode('utf-8'))
+    return h.hexdigest()
+
+class ResponseCache:
+    # ask_gemini_robust の前段に置くSQLiteキャッシュ。容量を超えたら最終アクセスが古い順に捨てる。
+    def __init__(self, path, max_bytes=RESPONSE_CACHE_MAX_BYTES):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.max_bytes = max_bytes
+        self.hits = self.misses = self.evictions = 0
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute("CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, value TEXT, size INTEGER, expires REAL, accessed REAL)")
+        self._db.execute("CREATE INDEX IF NOT EXISTS idx_responses_accessed ON responses(accessed)")
+        self._db.commit()
+        # 件数と合計サイズは起動時に1回だけ数え、以降は書き込みのたびに足し引きする
+        self._entries, self._total = self._db.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM responses").fetchone()
+        self._touched = {}   # キー → まだDBに書いていない最終アクセス時刻
+        self._touched_since = time.time()
+
+    def _flush_touched(self):
+        if self._touched:
+            self._db.executemany("UPDATE responses SET accessed=? WHERE key=?", [(t, k) for k, t in self._touched.items()])
+            self._touched.clear()
+        self._touched_since = time.time()
+
+    def _delete(self, key, size):
+        self._db.execute("DELETE FROM responses WHERE key=?", (key,))
+        self._touched.pop(key, None)
+        self._entries -= 1
+        self._total -= size
+
+    def get(self, key):
+        now = time.time()
+        with self._lock:
+            row = self._db.execute("SELECT value, expires, size FROM responses WHERE key=?", (key,)).fetchone()
+            if row and (row[1] is None or row[1] > now):
+                self._touched[key] = now
+                if len(self._touched) >= RESPONSE_CACHE_TOUCH_BATCH or now - self._touched_since >= RESPONSE_CACHE_TOUCH_SECONDS:
+                    self._flush_touched()
+                    self._db.commit()
+                self.hits += 1
+                return row[0]
+            if row:
+                self._delete(key, row[2])
+                self._db.commit()
+            self.misses += 1
+            return None
+
+    def put(self, key, value, ttl=None):
+        now = time.time()
+        size = len(value.encode('utf-8'))
+        with self._lock:
+            old = self._db.execute("SELECT size FROM responses WHERE key=?", (key,)).fetchone()
+            self._db.execute("INSERT OR REPLACE INTO responses VALUES (?,?,?,?,?)",
+                             (key, value, size, now + ttl if ttl else None, now))
+            self._touched.pop(key, None)
+            self._entries += 0 if old else 1
+            self._total += size - (old[0] if old else 0)
+            if self._total > self.max_bytes:
+                # 古い順に捨てるので、溜めておいたアクセス時刻を先に反映する
+                self._flush_touched()
+                for k, sz in self._db.execute("SELECT key, size FROM responses WHERE expires IS NOT NULL AND expires <= ?", (now,)).fetchall():
+                    self._delete(k, sz)
+                for k, sz in self._db.execute("SELECT key, size FROM responses ORDER BY accessed").fetchall():
+                    if self._total <= self.max_bytes: break
+                    self._delete(k, sz)
+                    self.evictions += 1
+            self._db.commit()
+
+    def stats(self):
+        with self._lock: n, size = self._entries, self._total
+        total = self.hits + self.misses
+        return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                'hit_rate': round(self.hits / total * 100, 1) if total else 0.0, 'entries': n, 'bytes': size}
+
+@st.cache_resource(show_spinner=False)
+def get_response_cache():
+    try: return ResponseCache(os.path.join(CACHE_DIR, "responses.sqlite3"))
+    except: return None
+
+response_cache = get_response_cache()
+
+# ---------------------------------------------------------
+# 🚦 Gemini呼び出し (レート制限・再試行・相乗り)
+# ---------------------------------------------------------
+# 同じAPIキーを全セッションで共有するので、制限はプロセス全体で掛ける。(毎分のリクエスト数, 瞬間的に許す数)
+RATE_LIMITS = {
+    "pro": (int(os.environ.get("JUKEN_RPM_PRO", "30")), 5),
+    "flash": (int(os.environ.get("JUKEN_RPM_FLASH", "60")), 10),
+}
+GEMINI_MAX_RETRIES = 5
+BACKOFF_BASE = 2.0    # 秒
+BACKOFF_CAP = 60.0    # 秒
+
+def env_seconds(name, default):
+    value = os.environ.get(name, default)
+    return float(value) if value else None
+
+# ヘッジ: 呼び出し元ごとの締め切り(秒)。主モデル(Pro)がこの時間内に答えなければFlashにも同じ依頼を出し、
+# 先に返ってきた使える答えを採る。Flashの品質で十分な所だけ設定する (空にすると無効)
+HEDGE_DEADLINES = {
+    "classify": env_seconds("JUKEN_HEDGE_CLASSIFY", "8"),   # 単元分類
+    "practice": env_seconds("JUKEN_HEDGE_PRACTICE", "6"),   # TAB4 の問題作成
+}
+HEDGE_WORKERS = 8   # 追加で投げる fallback 用のスレッド数 (主モデルへの依頼はこのプールを使わない)
+
+class GeminiQuotaError(Exception):
+    pass
+
+class GeminiRejectedAnswer(Exception):
+    # どのモデルも accept を通る答えを返さなかった。最後の答えは text に入れておく (キャッシュはしない)
+    def __init__(self, text):
+        super().__init__("使える答えが得られませんでした")
+        self.text = text
+
+def is_quota_error(e):
+    return "429" in str(e) or "Quota" in str(e)
+
+def retry_hint(e):
+    # エラーにサーバー指定の待ち時間があれば取り出す
+    m = re.search(r'retry_delay\s*\{\s*seconds:\s*(\d+)', str(e)) or re.search(r'retry in ([\d.]+)\s*s', str(e), re.IGNORECASE)
+    return float(m.group(1)) if m else None
+
+class TokenBucket:
+    def __init__(self, per_minute, burst):
+        self.rate = per_minute / 60.0
+        self.capacity = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self):
+        # トークンを1つ予約し、使えるまでの待ち時間を返す (マイナス残高を許して到着順に並ばせる)
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= 1
+            return 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+
+    def drain(self):
+        # 429を受けたら貯まっている分を捨て、他の呼び出しも一緒に減速させる
+        with self._lock: self.tokens = min(self.tokens, 0.0)
+
+class GeminiClient:
+    # モデルごとのトークンバケット、ジッタ付き指数バックオフ、同一リクエストの相乗りをまとめる
+    def __init__(self, registry):
+        self.registry = registry
+        self._lock = threading.Lock()
+        self._buckets = {}
+        self._inflight = {}
+        self.requests = self.retries = self.coalesced = self.waiting = 0
+        self.waits = deque(maxlen=500)
+        self.hedges = {}   # 呼び出し元 → {'calls', 'hedged', 'wins': {role: 件数}}
+        self.hedge_latency = LatencyLog()
+        self._hedge_pool = ThreadPoolExecutor(max_workers=HEDGE_WORKERS, thread_name_prefix="hedge")
+
+    def _bucket(self, role, model_name):
+        # vision は Pro と同じモデルなのでバケットも共有する
+        with self._lock:
+            if model_name not in self._buckets:
+                self._buckets[model_name] = TokenBucket(*RATE_LIMITS["flash" if role == "flash" else "pro"])
+            return self._buckets[model_name]
+
+    def acquire(self, role):
+        wait = self._bucket(role, self.registry.model_name(role)).reserve()
+        with self._lock:
+            self.requests += 1
+            self.waits.append(wait)
+            if wait > 0: self.waiting += 1
+        if wait > 0:
+            try: time.sleep(wait)
+            finally:
+                with self._lock: self.waiting -= 1
+        return wait
+
+    def backoff(self, role, attempt, e):
+        self._bucket(role, self.registry.model_name(role)).drain()
+        with self._lock: self.retries += 1
+        hint = retry_hint(e)
+        if hint is not None: return hint + random.uniform(0, 1)
+        delay = min(BACKOFF_CAP, BACKOFF_BASE * 2 ** attempt)
+        return delay / 2 + random.uniform(0, delay / 2)
+
+    def generate(self, role, contents, site=None, config=None):
+        last = None
+        waited = 0.0
+        with tracer.span("gemini", role=role, site=site) as sp:
+            for attempt in range(GEMINI_MAX_RETRIES):
+                waited += self.acquire(role)
+                sp.set(attempts=attempt + 1, wait_ms=round(waited * 1000, 1))
+                try:
+                    resp = self.registry.model(role).generate_content(contents, generation_config=config)
+                    if tracer.enabled: sp.set(**usage_tokens(resp))
+                    return resp.text
+                except Exception as e:
+                    if not is_quota_error(e): raise
+                    last = e
+                    if attempt + 1 < GEMINI_MAX_RETRIES: time.sleep(self.backoff(role, attempt, e))
+            raise GeminiQuotaError(str(last))
+
+    def _start_now(self, fn, *args):
+        # 呼び出し元ごとに1本だけ使うスレッドで実行し、Future で結果を受け取る
+        fut = Future()
+        def run():
+            if not fut.set_running_or_notify_cancel(): return
+            try: fut.set_result(fn(*args))
+            except BaseException as e: fut.set_exception(e)
+        threading.Thread(target=run, name="hedge-primary", daemon=True).start()
+        return fut
+
+    def generate_hedged(self, role, fallback, contents, deadline, site, accept=None, config=None):
+        # 主モデルが deadline 秒以内に使える答えを返さなければ fallback にも投げ、先に来た使える答えを返す。
+        # 負けた方は未開始なら取り消し、実行中なら結果を捨てる。どちらも使えない答えなら GeminiRejectedAnswer
+        accept = accept or (lambda text: bool(text and text.strip()))
+        start = time.monotonic()
+        # 主モデルへの依頼はプールに並ばせず、すぐ始める (並んでいる間に締め切りが来て二重に投げないように)
+        futures = {self._start_now(self.generate, role, contents, site, config): role}
+        pending = set(futures)
+        hedged = False
+        errors, rejected = [], None
+        with tracer.span("gemini_hedge", site=site, primary=role) as sp:
+            while pending:
+                timeout = None if hedged else max(0.0, deadline - (time.monotonic() - start))
+                done, pending = wait(pending, timeout=timeout, return_when=FIRST_COMPLETED)
+                for fut in done:
+                    try: text = fut.result()
+                    except Exception as e:
+                        errors.append(e)
+                        continue
+                    if accept(text):
+                        for other in pending: other.cancel()
+                        self._record_hedge(site, futures[fut], hedged, time.monotonic() - start)
+                        sp.set(winner=futures[fut], hedged=hedged)
+                        return text
+                    rejected = text
+                if not hedged and (not done or not pending):
+                    # 締め切りを過ぎたか、主モデルが使えない答えを返した
+                    hedged = True
+                    fut = self._hedge_pool.submit(self.generate, fallback, contents, site, config)
+                    futures[fut] = fallback
+                    pending.add(fut)
+            sp.set(winner=None, hedged=hedged)
+        self._record_hedge(site, None, hedged, time.monotonic() - start)
+        if rejected is not None: raise GeminiRejectedAnswer(rejected)
+        if all(isinstance(e, GeminiQuotaError) for e in errors): raise errors[0]
+        raise next(e for e in errors if not isinstance(e, GeminiQuotaError))
+
+    def _record_hedge(self, site, winner, hedged, seconds):
+        with self._lock:
+            h = self.hedges.setdefault(site, {'calls': 0, 'hedged': 0, 'wins': {}})
+            h['calls'] += 1
+            h['hedged'] += hedged
+            h['wins'][winner] = h['wins'].get(winner, 0) + 1
+        self.hedge_latency.add(f"{site}:{winner}", seconds)
+
+    def hedge_stats(self):
+        # 呼び出し元ごとの勝者と、勝者別の所要時間
+        with self._lock: hedges = {site: {**h, 'wins': dict(h['wins'])} for site, h in self.hedges.items()}
+        for site, h in hedges.items():
+            h['latency'] = {winner: self.hedge_latency.summary(f"{site}:{winner}") for winner in h['wins']}
+        return hedges
+
+    def coalesce(self, key, fn):
+        # 同じキーの呼び出しが実行中なら、その結果を待って共有する
+        with self._lock:
+            fut = self._inflight.get(key)
+            leader = fut is None
+            if leader: fut = self._inflight[key] = Future()
+            else: self.coalesced += 1
+        if not leader: return fut.result()
         try:
-            if image_list: response = target_model.generate_content([prompt] + image_list)
-            else: response = target_model.generate_content(prompt)
-            return response.text
-        except Exception as e:
-            if "429" in str(e) or "Quota" in str(e):
-                time.sleep((attempt + 1) * 3)
-            else: return f"エラー: {e}"
-    return "❌ 応答できませんでした。"
+            result = fn()
+            fut.set_result(result)
+            return result
+        except BaseException as e:
+            fut.set_exception(e)
+            raise
+        finally:
+            with self._lock: self._inflight.pop(key, None)
+
+    def stats(self):
+        with self._lock:
+            waits = sorted(self.waits)
+            return {'requests': self.requests, 'retries': self.retries, 'coalesced': self.coalesced,
+                    'queue_depth': self.waiting, 'inflight': len(self._inflight),
+                    'wait_avg': sum(waits) / len(waits) if waits else 0.0,
+                    'wait_p90': waits[min(len(waits) - 1, int(len(waits) * 0.9))] if waits else 0.0}
+
+@st.cache_resource(show_spinner=False)
+def get_gemini_client(_registry):
+    return GeminiClient(_registry)
+
+gemini_client = get_gemini_client(model_registry)
+
+# ---------------------------------------------------------
+# 🔈 音声合成 (キャッシュ & 先行合成)
+# ---------------------------------------------------------
+TTS_CACHE_MAX_BYTES = 32 * 1024 * 1024
+TTS_WORKERS = 2
+
+class GTTSSynthesizer:
+    # 合成器は available と synthesize(text, lang) -> mp3バイト列 を持てば差し替えられる
+    available = module_available("gtts")
+
+    def synthesize(self, text, lang):
+        fp = io.BytesIO()
+        with tracer.span("tts", chars=len(text)): gtts.gTTS(text=text, lang=lang).write_to_fp(fp)
+        return fp.getvalue()
+
+class AudioCache:
+    # 台本と言語のハッシュ → 音声。合成はバックグラウンドで行い、容量を超えたら古い順に捨てる
+    def __init__(self, synthesizer, max_bytes=TTS_CACHE_MAX_BYTES):
+        self.synthesizer = synthesizer
+        self.max_bytes = max_bytes
+        self._data = OrderedDict()
+        self._bytes = 0
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=TTS_WORKERS, thread_name_prefix="tts")
+
+    @staticmethod
+    def key(text, lang):
+        return hashlib.sha256(f"{lang}\0{text}".encode('utf-8')).hexdigest()
+
+    def _synthesize(self, key, text, lang):
+        try: data = self.synthesizer.synthesize(text, lang)
+        finally:
+            with self._lock: self._pending.pop(key, None)
+        with self._lock:
+            if key not in self._data:
+                self._data[key] = data
+                self._bytes += len(data)
+            while self._bytes > self.max_bytes and len(self._data) > 1:
+                _, old = self._data.popitem(last=False)
+                self._bytes -= len(old)
+        return data
+
+    def prefetch(self, text, lang='en'):
+        key = self.key(text, lang)
+        with self._lock:
+            if key in self._data:
+                self._data.move_to_end(key)
+                fut = Future()
+                fut.set_result(self._data[key])
+                return fut
+            if key not in self._pending:
+                self._pending[key] = self._executor.submit(self._synthesize, key, text, lang)
+            return self._pending[key]
+
+    def get(self, text, lang='en'):
+        try: return self.prefetch(text, lang).result()
+        except Exception: return None
+
+@st.cache_resource(show_spinner=False)
+def get_audio_cache(_synthesizer):
+    return AudioCache(_synthesizer)
+
+audio_cache = get_audio_cache(GTTSSynthesizer())
+
+def clean_script(text):
+    return text.replace("A:", " ").replace("B:", " ").replace("M:", " ").replace("W:", " ")
+
+def prefetch_speech(text, lang='en'):
+    # 問題を作った時点で合成を始めておく
+    if text and audio_cache.synthesizer.available: audio_cache.prefetch(clean_script(text), lang)
 
 def text_to_speech(text, lang='en'):
-    if gTTS is None: return None
+    if not audio_cache.synthesizer.available or not text: return None
+    data = audio_cache.get(clean_script(text), lang)
+    return io.BytesIO(data) if data else None
+
+# ---------------------------------------------------------
+# 🖼️ 画像の前処理 (AIに送る前に縮小・再圧縮)
+# ---------------------------------------------------------
+IMAGE_MAX_EDGE = int(os.environ.get("JUKEN_IMAGE_MAX_EDGE", "1600"))      # 長辺の最大ピクセル数
+IMAGE_TARGET_BYTES = int(os.environ.get("JUKEN_IMAGE_TARGET_KB", "400")) * 1024
+IMAGE_JPEG_QUALITIES = (85, 75, 65, 50)
+IMAGE_MODES = {"文書 (グレー)": "gray", "文書 (白黒)": "binary", "カラー": "color"}
+
+def otsu_threshold(gray):
+    # 大津の二値化: クラス間分散が最大になるしきい値
+    hist = gray.histogram()
+    total = sum(hist)
+    sum_all = sum(i * h for i, h in enumerate(hist))
+    w0 = s0 = 0
+    best_var, best_t = 0.0, 128
+    for t, h in enumerate(hist):
+        w0 += h
+        if w0 == 0: continue
+        w1 = total - w0
+        if w1 == 0: break
+        s0 += t * h
+        var = w0 * w1 * (s0 / w0 - (sum_all - s0) / w1) ** 2
+        if var > best_var: best_var, best_t = var, t
+    return best_t
+
+@st.cache_data(show_spinner=False, max_entries=64)
+def prepare_image_bytes(raw, mode="gray"):
+    # EXIFの向きを反映 → 縮小 → (文書モードなら)グレー/白黒化 → 目標サイズ以下に再圧縮
+    img = ImageOps.exif_transpose(Image.open(io.BytesIO(raw)))
+    img.thumbnail((IMAGE_MAX_EDGE, IMAGE_MAX_EDGE), Image.Resampling.LANCZOS)
+    if mode == "binary":
+        gray = ImageOps.autocontrast(img.convert('L'), cutoff=1)
+        t = otsu_threshold(gray)
+        buf = io.BytesIO()
+        gray.point(lambda p: 255 if p > t else 0).convert('1').save(buf, format='PNG', optimize=True)
+        data, mime = buf.getvalue(), 'image/png'
+    else:
+        img = ImageOps.autocontrast(img.convert('L'), cutoff=1) if mode == "gray" else img.convert('RGB')
+        for quality in IMAGE_JPEG_QUALITIES:
+            buf = io.BytesIO()
+            img.save(buf, format='JPEG', quality=quality, optimize=True)
+            if buf.tell() <= IMAGE_TARGET_BYTES: break
+        data, mime = buf.getvalue(), 'image/jpeg'
+    return {'mime_type': mime, 'data': data}, {'digest': hashlib.sha256(raw).hexdigest()[:16], 'original': len(raw), 'sent': len(data), 'size': img.size}
+
+def prepare_images(files, mode="gray"):
+    # アップロードされた画像をまとめて前処理 → (AIに渡す画像リスト, 合計の元サイズ, 合計の送信サイズ)
+    images, original, sent = [], 0, 0
+    for f in files:
+        image, info = prepare_image_bytes(f.getvalue(), mode)
+        images.append(image)
+        original += info['original']
+        sent += info['sent']
+    return images, original, sent
+
+def image_savings_caption(original, sent):
+    saved = 100 - sent * 100 // original if original else 0
+    return f"📉 画像サイズ: {original // 1024}KB → {sent // 1024}KB ({saved}% 削減)"
+
+# ---------------------------------------------------------
+# 🛠️ 関数定義
+# ---------------------------------------------------------
+STREAM_RESPONSES = True   # アドバイス・テスト・採点は生成しながら表示する
+
+@st.cache_resource(show_spinner=False)
+def get_ttft_log():
+    return LatencyLog()
+
+ttft_log = get_ttft_log()
+
+def pick_role(image_list=None, use_flash=False):
+    if image_list: return "vision"
+    if use_flash: return "flash"
+    return "pro"
+
+def ask_gemini_robust(prompt, image_list=None, use_flash=False, cache_site="default", hedge=None, accept=None, schema=None):
+    # hedge: HEDGE_DEADLINES のキー。締め切りを過ぎたらFlashにも投げる。accept(text) で使える答えか判定する
+    # schema: 指定するとJSONモード (response_schema) で返させる
+    role = pick_role(image_list, use_flash)
+    deadline = HEDGE_DEADLINES.get(hedge) if hedge and role != "flash" else None
+    contents = [prompt] + image_list if image_list else prompt
+    config = {"response_mime_type": "application/json", "response_schema": schema} if schema else None
+    cache = response_cache if cache_site else None
+    if cache:
+        cache_key = make_cache_key(model_registry.model_name(role), prompt, image_list, schema)
+        with tracer.span("cache_lookup", site=cache_site) as sp:
+            cached = cache.get(cache_key)
+            sp.set(hit=cached is not None)
+        if cached is not None: return cached
+    def call():
+        try:
+            if deadline is not None: text = gemini_client.generate_hedged(role, "flash", contents, deadline, hedge, accept, config)
+            else: text = gemini_client.generate(role, contents, site=cache_site, config=config)
+        except GeminiRejectedAnswer as e: return e.text
+        # 使えない答えはキャッシュしない (呼び出し側の再試行・修復に任せる)
+        if cache and (accept is None or accept(text)): cache.put(cache_key, text, CACHE_TTL.get(cache_site, CACHE_TTL["default"]))
+        return text
     try:
-        processed_text = text.replace("A:", " ").replace("B:", " ").replace("M:", " ").replace("W:", " ")
-        tts = gTTS(text=processed_text, lang=lang)
-        fp = io.BytesIO()
-        tts.write_to_fp(fp)
-        fp.seek(0)
-        return fp
-    except: return None
+        # キャッシュ対象の呼び出しは、他のセッションと同時に同じものを頼んだら1回にまとめる
+        return gemini_client.coalesce(cache_key, call) if cache else call()
+    except GeminiQuotaError: return "❌ 応答できませんでした。"
+    except Exception as e: return f"エラー: {e}"
 
-def parse_csv(file):
+def stream_gemini(prompt, image_list=None, use_flash=False, cache_site="default"):
+    # ask_gemini_robust のストリーミング版 (st.write_stream 用)。
+    # 再試行は最初の文字を受け取る前だけ。途中で切れた場合は受け取った分にエラーを付けて終わる
+    role = pick_role(image_list, use_flash)
+    cache = response_cache if cache_site else None
+    if cache:
+        cache_key = make_cache_key(model_registry.model_name(role), prompt, image_list)
+        with tracer.span("cache_lookup", site=cache_site) as sp:
+            cached = cache.get(cache_key)
+            sp.set(hit=cached is not None)
+        if cached is not None:
+            yield cached
+            return
+    start = time.time()
+    with tracer.span("gemini_stream", role=role, site=cache_site) as sp:
+        for attempt in range(GEMINI_MAX_RETRIES):
+            sp.set(attempts=attempt + 1)
+            received = []
+            chunk = None
+            try:
+                gemini_client.acquire(role)
+                target_model = model_registry.model(role)
+                contents = [prompt] + image_list if image_list else prompt
+                for chunk in target_model.generate_content(contents, stream=True):
+                    try: text = chunk.text
+                    except ValueError: continue
+                    if not text: continue
+                    if not received:
+                        ttft_log.add(cache_site or role, time.time() - start)
+                        sp.set(ttft_ms=round((time.time() - start) * 1000, 1))
+                    received.append(text)
+                    yield text
+                # トークン数は最後のチャンクに入っている
+                if tracer.enabled: sp.set(**usage_tokens(chunk))
+                # 全チャンクが空 (安全フィルタ等でブロック) の場合はキャッシュせず、その旨を返す
+                if not received:
+                    sp.set(empty=True)
+                    yield "❌ 回答が得られませんでした（安全フィルタで止められた可能性があります）。"
+                    return
+                if cache: cache.put(cache_key, "".join(received), CACHE_TTL.get(cache_site, CACHE_TTL["default"]))
+                return
+            except Exception as e:
+                if received:
+                    yield f"\n\nエラー: {e}"
+                    return
+                if not is_quota_error(e):
+                    yield f"エラー: {e}"
+                    return
+                if attempt + 1 < GEMINI_MAX_RETRIES: time.sleep(gemini_client.backoff(role, attempt, e))
+    yield "❌ 応答できませんでした。"
+
+def render_gemini(prompt, image_list=None, use_flash=False, cache_site="default", spinner="AIが考え中..."):
+    # 生成しながら画面に出し、最終的なテキストを返す
+    if STREAM_RESPONSES: return st.write_stream(stream_gemini(prompt, image_list, use_flash, cache_site))
+    with st.spinner(spinner): text = ask_gemini_robust(prompt, image_list, use_flash, cache_site)
+    st.markdown(text)
+    return text
+
+CSV_SNIFF_BYTES = 64 * 1024   # 文字コード判定に使う先頭バイト数
+# 欠損として扱うセルの値 (pandas.read_csv の既定と同じ)
+CSV_NA_VALUES = frozenset(['', '#N/A', '#N/A N/A', '#NA', '-1.#IND', '-1.#QNAN', '-NaN', '-nan', '1.#IND', '1.#QNAN',
+                           '<NA>', 'N/A', 'NA', 'NULL', 'NaN', 'None', 'n/a', 'nan', 'null'])
+
+class CsvParseError(Exception):
+    pass
+
+SCORE_COLUMNS = ['点数', '配点']
+
+def compact_scores(values):
+    # 点数・配点: 数値にできないものは0、整数だけなら収まる最小の整数型、それ以外は float32
+    vals = pd.to_numeric(values, errors='coerce')
+    vals = np.where(np.isnan(vals), 0, vals) if vals.dtype.kind == 'f' else vals
+    if (vals % 1 == 0).all(): return pd.to_numeric(vals.astype('int64'), downcast='integer')
+    return vals.astype('float32')
+
+def compact_frame(df):
+    # 文字列の列はカテゴリ型、点数・配点は値が収まる最小の数値型にしてセッションのメモリを抑える
+    df = df.copy(deep=False)
+    for c in df.columns:
+        col = df[c]
+        if c in SCORE_COLUMNS: df[c] = compact_scores(col.to_numpy())
+        elif not pd.api.types.is_numeric_dtype(col) and not isinstance(col.dtype, pd.CategoricalDtype):
+            df[c] = col.astype('category')
+    return df
+
+def frame_bytes(df):
+    return int(df.memory_usage(deep=True).sum()) if len(df.columns) else 0
+
+def part_bytes(df):
+    # 整形済みデータは 内容 列以外を data_store と共有しているので、作り直した 内容 列だけ数える
+    # (共有のカテゴリ型の一覧はファイルごとには数えない)
+    if '内容' not in df.columns: return 0
+    col = df['内容']
+    if col.dtype == category_dtype(): return int(col.array.codes.nbytes)
+    return int(col.memory_usage(deep=True, index=False))
+
+def loaded_frames(store):
+    # ログイン中はまだ読み込んでいないファイルを数えない (再実行でクラスが作り直されるので isinstance は使えない)
+    loaded = getattr(store, 'loaded', None)
+    return loaded() if loaded else store.values()
+
+def session_memory_report():
+    # data_version が変わった時だけ測り直す
+    version = st.session_state.get('data_version', 0)
+    report = st.session_state.get('memory_report')
+    if report is None or report['version'] != version:
+        report = {'version': version,
+                  'data_store': sum(frame_bytes(df) for df in loaded_frames(st.session_state['data_store'])),
+                  'clean_parts': sum(part_bytes(df) for df in st.session_state['clean_parts'].values())}
+        st.session_state['memory_report'] = report
+    return report
+
+def sniff_encoding(raw):
+    head = raw[:CSV_SNIFF_BYTES]
+    if head.startswith(codecs.BOM_UTF8): return 'utf-8-sig'
     try:
-        file.seek(0)
-        try: df = pd.read_csv(file, header=None)
-        except: 
-            file.seek(0)
-            df = pd.read_csv(file, header=None, encoding='cp932')
-        header_row_mask = df.apply(lambda r: r.astype(str).str.contains('大問|内容').any(), axis=1)
-        if len(df[header_row_mask]) > 0:
-            idx = df[header_row_mask].index[0]
-            col_idx = 0
-            for c in df.columns:
-                val = str(df.iloc[idx][c])
-                if '大問' in val or '内容' in val:
-                    col_idx = c
-                    break
-            subset = df.iloc[idx:, col_idx:].reset_index(drop=True).T
-            raw_cols = [str(val).strip() for val in subset.iloc[0]]
-            new_cols = []
-            seen = {}
-            for c in raw_cols:
-                if c in seen: seen[c]+=1; new_cols.append(f"{c}_{seen[c]}")
-                else: seen[c]=0; new_cols.append(c)
-            subset.columns = new_cols
-            subset = subset[1:]
-            if '大問' in subset.columns: subset = subset.dropna(subset=['大問'])
-            subset['点数'] = pd.to_numeric(subset['点数'], errors='coerce').fillna(0)
-            subset['配点'] = pd.to_numeric(subset['配点'], errors='coerce').fillna(0)
-            subset['ファイル名'] = str(file.name)
-            name_str = str(file.name)
-            subj = 'その他'
-            for s in ['数学','英語','理科','社会','国語']:
-                if s in name_str: subj=s
-            subset['教科'] = subj
-            if '反省' in subset.columns: subset['反省'] = subset['反省'].fillna("").astype(str)
-            if '点数' in subset.columns: return subset
-    except: pass
+        head.decode('utf-8')
+        return 'utf-8'
+    except UnicodeDecodeError as e:
+        # 読み取り範囲の末尾でマルチバイト文字が切れただけならUTF-8
+        if e.reason == 'unexpected end of data': return 'utf-8'
+        return 'cp932'
+
+def parse_csv_bytes(raw, name):
+    with tracer.span("parse_csv", bytes=len(raw)): return _parse_csv_bytes(raw, name)
+
+def small_categorical(values):
+    # 数十件の列は pd.Categorical の推定・factorize より辞書で符号化した方が速い (None は欠損)。
+    # 集計の並び順が変わらないよう、カテゴリは pd.Categorical と同じく昇順にする
+    cats = sorted({v for v in values if v is not None})
+    pos = {v: i for i, v in enumerate(cats)}
+    codes = np.array([-1 if v is None else pos[v] for v in values], dtype=np.int8 if len(cats) < 127 else np.int32)
+    return pd.Categorical.from_codes(codes, cats)
+
+def _parse_csv_bytes(raw, name):
+    # 1ファイルは数十セルしかないので、pandas の読み込み・転置を使わず csv モジュールで組み立て、
+    # 列ごとに1回だけ型を決めて DataFrame を作る (ファイルごとの固定費が大半だったため)
+    if not raw.strip(): raise CsvParseError("空のファイルです")
+    enc = sniff_encoding(raw)
+    try: text = raw.decode(enc)
+    except UnicodeDecodeError: raise CsvParseError(f"文字コード({enc})として読めません")
+    try: rows = list(csv.reader(io.StringIO(text, newline='')))
+    except csv.Error as e: raise CsvParseError(f"CSVとして読めません: {e}")
+    rows = [[None if v in CSV_NA_VALUES else v for v in r] for r in rows]
+
+    # 「大問」「内容」を含む最初のセル (行優先) が見出しの起点
+    start = next(((i, j) for i, r in enumerate(rows) for j, v in enumerate(r) if v is not None and ('大問' in v or '内容' in v)), None)
+    if start is None: raise CsvParseError("「大問」または「内容」の見出しが見つかりません")
+    idx, col_idx = start
+    # 見出しの列から右が1問ずつ。行ごとに列数が違っても読めるよう、最も長い行に揃える
+    width = max(len(r) for r in rows)
+    block = [r[col_idx:] + [None] * (width - max(len(r), col_idx)) for r in rows[idx:]]
+    raw_cols = ['nan' if r[0] is None else r[0].strip() for r in block]
+    seen, cols = {}, []
+    for c in raw_cols:
+        n = seen[c] = seen.get(c, -1) + 1
+        cols.append(c if n == 0 else f"{c}_{n}")
+    missing = [c for c in ['点数', '配点'] if c not in cols]
+    if missing: raise CsvParseError(f"「{'」「'.join(missing)}」の行がありません")
+
+    keep = range(1, width - col_idx)
+    if '大問' in cols:
+        q = block[cols.index('大問')]
+        keep = [k for k in keep if q[k] is not None]
+    n = len(keep)
+    data = {}
+    for c, r in zip(cols, block):
+        values = [r[k] for k in keep]
+        if c in SCORE_COLUMNS: data[c] = compact_scores(np.array(values, dtype=object))
+        elif c == '反省': data[c] = small_categorical(["" if v is None else v for v in values])
+        else: data[c] = small_categorical(values)
+    data['ファイル名'] = pd.Categorical.from_codes(np.zeros(n, dtype=np.int8), [name])
+    subj = 'その他'
+    for s in ['数学','英語','理科','社会','国語']:
+        if s in name: subj=s
+    data['教科'] = pd.Categorical.from_codes(np.zeros(n, dtype=np.int8), [subj])
+    return pd.DataFrame(data, index=[col_idx + k for k in keep])
+
+def parse_csv(file):
+    file.seek(0)
+    return parse_csv_bytes(file.read(), str(file.name))
+
+def content_hash(raw, name=""):
+    # data_store のキー。df はファイル名 (教科・ファイル名列) にも依存するので名前ごとハッシュする
+    return hashlib.sha256(name.encode('utf-8') + b"\0" + raw).hexdigest()[:16]
+
+def parse_csv_files(files, known=()):
+    # 複数ファイルを解析 → ({ファイル名+内容のハッシュ: df}, {ファイル名: エラー内容}, スキップ数)
+    # known に含まれる(=同じ名前で解析済み・中身も変わっていない)ファイルは読み直さない。
+    # 1ファイル1ms程度でGILに縛られるため、スレッドに分けても速くならないので順に読む
+    frames, errors = {}, {}
+    skipped = 0
+    for f in files:
+        f.seek(0)
+        raw = f.read()
+        name = str(f.name)
+        key = content_hash(raw, name)
+        if key in known:
+            skipped += 1
+            continue
+        try: frames[key] = parse_csv_bytes(raw, name)
+        except CsvParseError as e: errors[name] = str(e)
+        except Exception as e: errors[name] = f"予期しないエラー: {e}"
+    return frames, errors, skipped
+
+def store_entry_name(df):
+    return str(df['ファイル名'].iloc[0]) if len(df) and 'ファイル名' in df.columns else ""
+
+def store_names(store):
+    # {キー: ファイル名}。ログイン中はDBに保存してある名前を使い、ファイルの中身は読まない
+    names = getattr(store, 'names', None)
+    return names() if names else {k: store_entry_name(df) for k, df in store.items()}
+
+def add_to_data_store(frames):
+    # 同じファイル名で中身が変わったものは古い版を置き換える
+    store = st.session_state['data_store']
+    new_names = {store_entry_name(df) for df in frames.values()}
+    for key in [k for k, name in store_names(store).items() if k not in frames and name in new_names]:
+        del store[key]
+    store.update(frames)
+
+def bump_data_version():
+    # clean_parts が変わるたびに上げる。集計キャッシュはこの番号で有効性を判定する
+    st.session_state['data_version'] = st.session_state.get('data_version', 0) + 1
+
+def reset_analysis():
+    bump_data_version()
+    st.session_state['clean_parts'] = {}
+    st.session_state['unresolved_pairs'] = []
+
+CLASSIFY_CHUNK_SIZE = 20     # 1リクエストあたりの単元数
+CLASSIFY_MAX_WORKERS = 4     # 同時に投げるリクエスト数
+CLASSIFY_MAX_RETRIES = 2     # チャンクごとの再試行回数
+
+def extract_json_object(text):
+    # 貪欲な \{.*\} ではなく、先頭から順に最初に読めるJSONオブジェクトを取り出す
+    decoder = json.JSONDecoder()
+    for m in re.finditer(r'\{', str(text)):
+        try: obj, _ = decoder.raw_decode(text, m.start())
+        except ValueError: continue
+        if isinstance(obj, dict): return obj
     return None
 
+# 構造化出力: JSONモード (response_schema) で返させ、用途ごとの検証に落ちた項目だけをFlashで直す
+STRUCTURED_REPAIR_ROUNDS = 1
+
+LISTENING_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "script": {"type": "string"},
+        "question": {"type": "string"},
+        "options": {"type": "array", "items": {"type": "string"}},
+        "answer": {"type": "string"},
+        "explanation": {"type": "string"},
+    },
+    "required": ["script", "question", "options", "answer", "explanation"],
+}
+PRACTICE_SCHEMA = {
+    "type": "object",
+    "properties": {"question": {"type": "string"}, "answer": {"type": "string"}},
+    "required": ["question", "answer"],
+}
+
+def classify_schema(categories):
+    # スキーマでは任意のキーを持つ辞書を表せないので {input, category} の配列にし、カテゴリは列挙で縛る
+    item = {"type": "object", "properties": {"input": {"type": "string"}, "category": {"type": "string", "enum": list(categories)}}, "required": ["input", "category"]}
+    return {"type": "object", "properties": {"items": {"type": "array", "items": item}}, "required": ["items"]}
+
+def parse_structured(text):
+    # JSONモードでも前後に余計な文字が付いた時は最初のオブジェクトを拾う
+    try: data = json.loads(text)
+    except (TypeError, ValueError): data = extract_json_object(text)
+    return data if isinstance(data, dict) else None
+
+def is_blank(value):
+    return not isinstance(value, str) or not value.strip()
+
+# 検証関数は {項目: 直してほしい内容} を返す (空なら合格)
+def validate_practice(data):
+    return {k: "空です" for k in ("question", "answer") if is_blank(data.get(k))}
+
+def validate_listening(data):
+    errors = {k: "空です" for k in ("script", "question", "explanation") if is_blank(data.get(k))}
+    options = data.get('options')
+    if not isinstance(options, list) or len({o.strip() for o in options if not is_blank(o)}) < 2:
+        errors['options'] = "異なる選択肢を2つ以上"
+        errors['answer'] = "options のいずれかと完全に同じ文字列"
+    elif data.get('answer') not in options:
+        errors['answer'] = f"options {json.dumps(options, ensure_ascii=False)} のいずれかと完全に同じ文字列"
+    return errors
+
+def ask_gemini_json(prompt, schema, validate, use_flash=False, cache_site=None, hedge=None):
+    # 作り直さずに、落ちた項目だけを部分スキーマで問い直して差し替える。直らなければ None
+    def usable(text):
+        data = parse_structured(text)
+        return data is not None and not validate(data)
+    with tracer.span("structured", site=hedge or cache_site) as sp:
+        data = parse_structured(ask_gemini_robust(prompt, use_flash=use_flash, cache_site=cache_site, hedge=hedge, accept=usable, schema=schema))
+        if data is None: return None
+        errors = validate(data)
+        repaired = []
+        for _ in range(STRUCTURED_REPAIR_ROUNDS):
+            if not errors: break
+            fields = list(errors)
+            sub = {"type": "object", "properties": {k: schema["properties"][k] for k in fields}, "required": fields}
+            fix = f"次のJSONは一部の項目が条件を満たしていません。指摘された項目だけを直し、その項目のみをJSONで出力してください。\n元の依頼: {prompt.strip()}\nJSON: {json.dumps(data, ensure_ascii=False)}\n指摘: {json.dumps(errors, ensure_ascii=False)}"
+            patch = parse_structured(ask_gemini_robust(fix, use_flash=True, cache_site=None, schema=sub))
+            if not patch: break
+            data.update({k: patch[k] for k in fields if k in patch})
+            repaired += fields
+            errors = validate(data)
+        sp.set(repaired=",".join(repaired), valid=not errors)
+    return None if errors else data
+
+def classify_chunk(pairs):
+    # pairs: [(教科, 単元)] → {(教科, 単元): カテゴリ}。マスタにないカテゴリは不採用とし、残りだけを安いFlashで再試行する
+    result = {}
+    remaining = list(pairs)
+    for attempt in range(CLASSIFY_MAX_RETRIES + 1):
+        master = {s: FIXED_CATEGORIES[s] for s in dict.fromkeys(s for s, _ in remaining)}
+        inputs = [f"{s}: {t}" for s, t in remaining]
+        prompt = f"「教科:単元」を分析し、入力ごとに最も適切なカテゴリを items に出力せよ。\ninput は入力の文字列そのまま、category はその教科のマスタ内のカテゴリ名のみ。\nマスタ: {json.dumps(master, ensure_ascii=False)}\n入力: {inputs}"
+        if attempt: prompt += f"\n(再試行 {attempt}回目: 前回の出力は入力が欠けているか、教科に合わないカテゴリを含んでいました)"
+        schema = classify_schema(dict.fromkeys(c for cats in master.values() for c in cats))
+        reply = ask_gemini_robust(prompt, use_flash=attempt > 0, cache_site="classify", hedge="classify", accept=lambda t: parse_structured(t) is not None, schema=schema)
+        items = (parse_structured(reply) or {}).get('items')
+        for item in items if isinstance(items, list) else []:
+            if not isinstance(item, dict) or ':' not in str(item.get('input', '')): continue
+            subj, topic = str(item['input']).split(':', 1)
+            key, cat = (subj.strip(), topic.strip()), str(item.get('category', '')).strip()
+            if key in remaining and cat in FIXED_CATEGORIES[key[0]]: result[key] = cat
+        remaining = [p for p in remaining if p not in result]
+        if not remaining: break
+    return result
+
+# ローカル照合: この類似度以上かつ次点と十分に差があればAIに聞かずに確定する
+LOCAL_MATCH_THRESHOLD = float(os.environ.get("JUKEN_LOCAL_MATCH_THRESHOLD", "0.85"))
+LOCAL_MATCH_MARGIN = 0.05
+
+def normalize_unit(text):
+    t = unicodedata.normalize('NFKC', str(text)).lower()
+    return re.sub(r'[\s・、,./()「」【】\[\]]', '', t)
+
+def char_ngrams(text, n=2):
+    if len(text) < n: return {text}
+    return {text[i:i + n] for i in range(len(text) - n + 1)}
+
+class CategoryMatcher:
+    # FIXED_CATEGORIES に対する教科別の類似度インデックス。「【物理】」等の接頭辞なしの表記も登録しておく
+    def __init__(self, categories):
+        self.index = {}
+        for subj, cats in categories.items():
+            entries = []
+            for cat in cats:
+                for v in dict.fromkeys([normalize_unit(cat), normalize_unit(re.sub(r'^【.*?】', '', cat))]):
+                    entries.append((cat, v, char_ngrams(v)))
+            self.index[subj] = entries
+
+    def match(self, subj, topic):
+        # → (最も近いカテゴリ, 類似度, 次点との差)
+        q = normalize_unit(topic)
+        if not q or subj not in self.index: return None, 0.0, 0.0
+        q_grams = char_ngrams(q)
+        best = {}
+        for cat, v, grams in self.index[subj]:
+            if q == v: score = 1.0
+            else:
+                dice = 2 * len(q_grams & grams) / (len(q_grams) + len(grams))
+                score = max(dice, difflib.SequenceMatcher(None, q, v).ratio())
+            best[cat] = max(score, best.get(cat, 0.0))
+        ranked = sorted(best.items(), key=lambda x: -x[1])
+        second = ranked[1][1] if len(ranked) > 1 else 0.0
+        return ranked[0][0], ranked[0][1], ranked[0][1] - second
+
+    def resolve(self, subj, topic, threshold=LOCAL_MATCH_THRESHOLD):
+        cat, score, margin = self.match(subj, topic)
+        if cat and score >= threshold and (score == 1.0 or margin >= LOCAL_MATCH_MARGIN): return cat, score
+        return None, score
+
+@st.cache_resource(show_spinner=False)
+def get_category_matcher():
+    return CategoryMatcher(FIXED_CATEGORIES)
+
+def topic_pairs(df):
+    return set(zip(df['教科'], df['内容'].astype(str).str.strip()))
+
+@functools.lru_cache(maxsize=1)
+def category_dtype():
+    # マスタの全カテゴリを1つの型にまとめ、全ファイルで共有する (ファイルごとにカテゴリ一覧を持たない)
+    return pd.CategoricalDtype(sorted({c for cats in FIXED_CATEGORIES.values() for c in cats}))
+
+def clean_part(raw, cmap):
+    # 1ファイル分を整形し、単元名をカテゴリに置き換える。置き換えない列は data_store と共有する
+    part = raw.copy(deep=False)
+    if '詳細' not in part.columns: part['詳細'] = part['内容']
+    if '反省' not in part.columns: part['反省'] = ""
+    lookup = {f"{s}\0{t}": v for (s, t), v in cmap.items()}
+    keys = part['教科'].astype(str) + '\0' + part['内容'].astype(str).str.strip()
+    # ファイルごとに作り直すのはこの列だけなので、ここもカテゴリ型に戻して小さく持つ。
+    # 全てマスタのカテゴリなら共有の型、分類できなかった単元が残るファイルだけ独自のカテゴリにする
+    content = keys.map(lookup).fillna(part['内容'])
+    shared = category_dtype()
+    part['内容'] = content.astype(shared if content.isin(shared.categories).all() else 'category')
+    return part
+
 def process_and_categorize():
-    if not st.session_state['data_store']:
-        st.session_state['clean_df'] = pd.DataFrame()
+    with tracer.span("categorize", files=len(st.session_state['data_store'])): _process_and_categorize()
+
+def _process_and_categorize():
+    store = st.session_state['data_store']
+    parts = st.session_state['clean_parts']
+    if not store:
+        reset_analysis()
         return
-    with st.status(f"🚀 解析中... (Engine: {MODEL_NAME_PRO})", expanded=True) as status:
-        try:
-            raw_df = pd.concat(st.session_state['data_store'].values(), ignore_index=True)
-        except: return
-        
-        unique_pairs = raw_df[['教科', '内容']].drop_duplicates()
+    # データから消えたファイルの分は捨て、新しく入ったファイルの分だけ解析する
+    for key in [k for k in parts if k not in store]: del parts[key]
+    new_keys = [k for k in store if k not in parts]
+    cmap = st.session_state['category_map']
+    with st.status(f"🚀 解析中... (Engine: {model_registry.model_name('pro')})", expanded=True) as status:
+        status.write(f"📄 新規 {len(new_keys)}件 / 解析済み {len(parts)}件")
+        candidates = list(st.session_state['unresolved_pairs'])
+        for key in new_keys: candidates.extend(sorted(topic_pairs(store[key]), key=str))
         unknown_list = []
-        for _, row in unique_pairs.iterrows():
-            subj = row['教科']
-            topic = str(row['内容']).strip()
-            if subj in FIXED_CATEGORIES and topic in FIXED_CATEGORIES[subj]: continue
-            if (subj, topic) not in st.session_state['category_map']:
-                unknown_list.append(f"{subj}: {topic}")
+        for subj, topic in candidates:
+            # マスタのない教科(その他)は分類先がないのでそのまま
+            if subj not in FIXED_CATEGORIES or topic in FIXED_CATEGORIES[subj]: continue
+            if (subj, topic) not in cmap and (subj, topic) not in unknown_list:
+                unknown_list.append((subj, topic))
+        all_unknown = list(unknown_list)
         
+        # 表記ゆれ程度の単元はローカル照合で確定し、曖昧なものだけAIに回す
         if unknown_list:
-            categories_str = json.dumps(FIXED_CATEGORIES, ensure_ascii=False)
-            prompt = f"「教科:単元」を分析し、最も適切なカテゴリをJSON辞書で出力せよ。\nマスタ: {categories_str}\n入力: {unknown_list}"
-            response = ask_gemini_robust(prompt, use_flash=False)
-            try:
-                json_match = re.search(r'\{.*\}', response, re.DOTALL)
-                if json_match:
-                    mapping = json.loads(json_match.group())
-                    for k, v in mapping.items():
-                        if ':' in k: s, t = k.split(':', 1); st.session_state['category_map'][(s.strip(), t.strip())] = v.strip()
-            except: pass
-
-        df_clean = raw_df.copy()
-        if '詳細' not in df_clean.columns: df_clean['詳細'] = df_clean['内容']
-        if '反省' not in df_clean.columns: df_clean['反省'] = ""
-        def apply_mapping(row):
-            key = (row['教科'], str(row['内容']).strip())
-            return st.session_state['category_map'].get(key, row['内容'])
-        df_clean['内容'] = df_clean.apply(apply_mapping, axis=1)
-        st.session_state['clean_df'] = df_clean
+            matcher = get_category_matcher()
+            local_report = []
+            ai_list = []
+            for subj, topic in unknown_list:
+                cat, score = matcher.resolve(subj, topic)
+                if cat:
+                    cmap[(subj, topic)] = cat
+                    local_report.append({'教科': subj, '単元': topic, 'カテゴリ': cat, '類似度': round(score, 2)})
+                else: ai_list.append((subj, topic))
+            st.session_state['local_match_report'] = local_report
+            if local_report:
+                status.write(f"⚡ {len(local_report)}件 をローカル照合で分類しました (しきい値 {LOCAL_MATCH_THRESHOLD})")
+                st.dataframe(pd.DataFrame(local_report), use_container_width=True, hide_index=True)
+            unknown_list = ai_list
+
+        if unknown_list:
+            chunks = [unknown_list[i:i + CLASSIFY_CHUNK_SIZE] for i in range(0, len(unknown_list), CLASSIFY_CHUNK_SIZE)]
+            status.write(f"🧠 未分類の単元 {len(unknown_list)}件 を {len(chunks)}チャンクで分類中...")
+            progress = st.progress(0.0)
+            resolved = 0
+            with ThreadPoolExecutor(max_workers=min(CLASSIFY_MAX_WORKERS, len(chunks))) as pool:
+                futures = [pool.submit(classify_chunk, c) for c in chunks]
+                for i, fut in enumerate(as_completed(futures), 1):
+                    try: mapping = fut.result()
+                    except: mapping = {}
+                    cmap.update(mapping)
+                    resolved += len(mapping)
+                    progress.progress(i / len(chunks), text=f"{i}/{len(chunks)} チャンク完了 ({resolved}/{len(unknown_list)}件 分類済み)")
+            if resolved < len(unknown_list):
+                status.write(f"⚠️ {len(unknown_list) - resolved}件 は分類できなかったため元の単元名のまま集計します。次回の解析で再試行します。")
+
+        # 新規ファイルと、今回分類できた単元を含む解析済みファイルだけ作り直す
+        newly_mapped = {p for p in all_unknown if p in cmap}
+        st.session_state['unresolved_pairs'] = [p for p in all_unknown if p not in cmap]
+        stale = [k for k in parts if newly_mapped and topic_pairs(store[k]) & newly_mapped]
+        # 全ファイルを繋げた表は作らない。集計はファイル単位の rollup、単元の行は unit_rows で該当ファイルから取る
+        for key in new_keys + stale: parts[key] = clean_part(store[key], cmap)
+        bump_data_version()
         status.update(label="✅ 完了", state="complete", expanded=False)
 
 def get_status_emoji(rate):
@@ -322,35 +1704,585 @@ def get_status_emoji(rate):
     elif rate <= 70: return "🟡"
     else: return "🟢"
 
+def with_rate(df):
+    df['得点率(%)'] = (df['点数'] / df['配点'] * 100).fillna(0).round(1)
+    return df
+
+# 模試ごとの推移: ファイル単位の集計は clean_parts と一緒に持ち回り、増えた・作り直されたファイルの分だけ足す
+TREND_LAST_N = 3          # 「直近N回」の回数
+TREND_MAX_LINES = 5       # グラフに重ねる単元の上限
+TREND_CHART_CACHE = 32    # セッションに残すグラフ画像の数 (data_version が変わったら全て捨てる)
+JP_FONTS = ["Noto Sans CJK JP", "IPAexGothic", "IPAGothic", "Hiragino Sans", "Yu Gothic", "Meiryo", "TakaoGothic"]
+# グラフ用の日本語フォントのファイル。上から順に探す:
+# JUKEN_CHART_FONT で指定したもの → アプリと同じ場所の fonts/ に置いたもの → packages.txt (fonts-noto-cjk 等) で入るもの
+CHART_FONT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fonts")
+CHART_FONT_FILES = [
+    "/usr/share/fonts/opentype/noto/NotoSansCJK-Regular.ttc",
+    "/usr/share/fonts/noto-cjk/NotoSansCJK-Regular.ttc",
+    "/usr/share/fonts/opentype/ipaexfont-gothic/ipaexg.ttf",
+    "/usr/share/fonts/truetype/fonts-japanese-gothic.ttf",
+]
+
+def rollup_parts(parts):
+    # {キー: 整形済みdf} → 教科×単元×ファイル の合計 (_key 列付き)。
+    # ファイルごとに groupby すると数百ファイルで秒単位になるので、列を繋げて1回で集計する
+    keys = list(parts)
+    lens = [len(parts[k]) for k in keys]
+    batch = pd.DataFrame({
+        '_key': np.repeat(keys, lens),
+        'ファイル名': np.repeat([store_entry_name(parts[k]) for k in keys], lens),
+        **{c: np.concatenate([parts[k][c].to_numpy(dtype=object) for k in keys]) for c in ['教科', '内容']},
+        **{c: np.concatenate([pd.to_numeric(parts[k][c], errors='coerce').to_numpy(dtype=float) for k in keys]) for c in ['点数', '配点']},
+    })
+    return batch.groupby(['_key', '教科', '内容', 'ファイル名'], sort=False)[['点数', '配点']].sum().reset_index()
+
+def get_unit_file_rollup():
+    # clean_parts の中身が同じ (同一オブジェクト) ファイルは前回の集計を使い回し、増えた・変わった分だけ足す (_key 列付きで返す)
+    parts = st.session_state['clean_parts']
+    cache = st.session_state.get('unit_file_rollup') or {'parts': {}, 'frame': None}
+    changed = {k: part for k, part in parts.items() if cache['parts'].get(k) is not part}
+    dropped = [k for k in cache['parts'] if k not in parts or k in changed]
+    frame = cache['frame']
+    if frame is not None and dropped: frame = frame[~frame['_key'].isin(dropped)]
+    if changed: frame = rollup_parts(changed) if frame is None else pd.concat([frame, rollup_parts(changed)], ignore_index=True)
+    st.session_state['unit_file_rollup'] = {'parts': dict(parts), 'frame': frame}
+    return frame
+
+def exam_order_key(name):
+    # ファイル名の数字は数値として並べる (「第10回」を「第9回」の後に)
+    return [int(t) if t.isdigit() else t for t in re.split(r'(\d+)', name)]
+
+def build_trends(unit_file, last_n=TREND_LAST_N):
+    # 単元ごとの伸び(回帰の傾き)・ばらつき・直近N回を、グループごとの合計 (Σx, Σy, Σxy...) だけで一度に求める
+    df = unit_file.loc[unit_file['配点'] > 0, ['教科', '内容', 'ファイル名', '点数', '配点']].copy()
+    df['ファイル名'] = df['ファイル名'].astype(str)
+    names = sorted(df['ファイル名'].unique(), key=exam_order_key)
+    df['順'] = df['ファイル名'].map({n: i for i, n in enumerate(names)})
+    # 「回」は教科ごとに数え直す (他教科のファイルで間が空かないように)
+    df['回'] = df.groupby('教科', observed=True)['順'].rank(method='dense').astype(int) - 1
+    df['率'] = df['点数'] / df['配点'] * 100
+    df = df.sort_values(['教科', '回'], kind='stable').reset_index(drop=True)
+    x, y = df['回'].astype(float), df['率']
+    terms = pd.DataFrame({'教科': df['教科'], '内容': df['内容'], 'n': 1.0, 'x': x, 'y': y, 'xy': x * y, 'xx': x * x, 'yy': y * y})
+    sums = terms.groupby(['教科', '内容'], observed=True).sum()
+    n = sums['n']
+    mx, my = sums['x'] / n, sums['y'] / n
+    var_x = sums['xx'] / n - mx ** 2
+    slope = ((sums['xy'] / n - mx * my) / var_x).where(var_x > 1e-9)   # 1回分しかない単元は NaN
+    volatility = np.sqrt((sums['yy'] / n - my ** 2).clip(lower=0))
+    latest = df.groupby(['教科', '内容'], observed=True).cumcount(ascending=False) < last_n
+    recent = df[latest].groupby(['教科', '内容'], observed=True)[['点数', '配点']].sum()
+    trend = pd.DataFrame({
+        '回数': n.astype(int),
+        '直近(%)': (recent['点数'] / recent['配点'] * 100).round(1),
+        '伸び(pt/回)': slope.round(2),
+        'ばらつき(pt)': volatility.round(1),
+    }).reset_index()
+    exam_subject = with_rate(df.groupby(['教科', '回'], observed=True)[['点数', '配点']].sum().reset_index())
+    return trend, df[['教科', '内容', '回', 'ファイル名', '率']], exam_subject
+
+@functools.lru_cache(maxsize=1)
+def chart_font():
+    # ファイルは matplotlib のフォントキャッシュより後に入ることがあるので、見つけたら直接登録してその名前を使う
+    from matplotlib import font_manager
+    bundled = sorted(os.path.join(CHART_FONT_DIR, f) for f in os.listdir(CHART_FONT_DIR) if f.lower().endswith(('.ttf', '.otf', '.ttc'))) if os.path.isdir(CHART_FONT_DIR) else []
+    for path in [os.environ.get("JUKEN_CHART_FONT", ""), *bundled, *CHART_FONT_FILES]:
+        if not path or not os.path.isfile(path): continue
+        try:
+            font_manager.fontManager.addfont(path)
+            return font_manager.FontProperties(fname=path).get_name()
+        except Exception: continue
+    installed = {f.name for f in font_manager.fontManager.ttflist}
+    return next((f for f in JP_FONTS if f in installed), None)
+
+def draw_trend_chart(cube, subject, units):
+    # pyplot は使わない (状態を持たないのでスレッド・セッション間で混ざらない)
+    import matplotlib
+    from matplotlib.figure import Figure
+    font = chart_font()
+    with matplotlib.rc_context({'font.family': [font, 'sans-serif']} if font else {}):
+        fig = Figure(figsize=(7, 3.2), dpi=110)
+        ax = fig.add_subplot()
+        total = cube['exam_subject'][cube['exam_subject']['教科'] == subject]
+        marker = 'o' if len(total) <= 30 else None
+        ax.plot(total['回'] + 1, total['得点率(%)'], color='#1E3A8A', linewidth=2.5, marker=marker, label=f"{subject} 全体")
+        exams = cube['exam_unit']
+        exams = exams[(exams['教科'] == subject) & exams['内容'].isin(units)]
+        for unit, g in exams.groupby('内容', observed=True, sort=False):
+            ax.plot(g['回'] + 1, g['率'], linewidth=1.2, alpha=0.8, marker=marker, markersize=3, label=str(unit))
+        ax.set_ylim(0, 105)
+        ax.set_xlabel("回")
+        ax.set_ylabel("得点率(%)")
+        ax.grid(alpha=0.3)
+        ax.legend(fontsize=7, loc='lower left', ncol=2)
+        fig.tight_layout()
+        buf = io.BytesIO()
+        fig.savefig(buf, format='png')
+    return buf.getvalue()
+
+def get_trend_chart(cube, subject, units):
+    # 画像は data_version ごとに作り直す。同じ版・同じ組み合わせなら描かない
+    charts = st.session_state.get('trend_charts')
+    if charts is None or charts['version'] != cube['version']:
+        charts = st.session_state['trend_charts'] = {'version': cube['version'], 'images': {}}
+    key = (subject, tuple(units))
+    images = charts['images']
+    if key not in images:
+        with tracer.span("trend_chart", units=len(units)): images[key] = draw_trend_chart(cube, subject, units)
+        while len(images) > TREND_CHART_CACHE: del images[next(iter(images))]
+    return images[key]
+
+def build_summary_cube(unit_file):
+    # 教科×単元×ファイル の集計 (get_unit_file_rollup) から単元別・教科別・ワーストN・推移を作る
+    files = unit_file.groupby(['教科', '内容'], sort=False)['_key'].unique()
+    unit_file = unit_file.drop(columns='_key')
+    unit = with_rate(unit_file.groupby(['教科', '内容'], observed=True)[['点数', '配点']].sum().reset_index())
+    unit['判定'] = unit['得点率(%)'].apply(get_status_emoji)
+    subject = with_rate(unit.groupby('教科', observed=True)[['点数', '配点']].sum().reset_index())
+    ranked = unit.sort_values('得点率(%)', kind='stable')
+    limit = np.where(ranked['教科'].isin(['理科', '社会']), 5, 2)
+    urgent = ranked[ranked.groupby('教科', observed=True).cumcount() < limit].sort_values('教科', kind='stable')
+    trend, exam_unit, exam_subject = build_trends(unit_file)
+    return {
+        'unit_file': with_rate(unit_file),
+        'unit': unit,
+        'subject': subject,
+        'urgent': urgent,
+        'ranked': ranked,
+        'topics': {subj: g for subj, g in ranked.groupby('教科', sort=False, observed=True)},
+        'files': files.to_dict(),       # (教科, 単元) → その単元を含む clean_parts のキー
+        'trend': trend,                 # 教科×単元ごとの 回数・直近N回・伸び・ばらつき
+        'exam_unit': exam_unit,         # 教科×単元×回 の得点率
+        'exam_subject': exam_subject,   # 教科×回 の得点率
+    }
+
+def unit_rows(cube, subject, topic):
+    # 1単元分の行を、その単元を含むファイルからだけ取り出す (並びは data_store の順)
+    keys = set(cube['files'].get((subject, topic), ()))
+    rows = [df[(df['教科'] == subject) & (df['内容'] == topic)] for k, df in st.session_state['clean_parts'].items() if k in keys]
+    return pd.concat(rows) if rows else pd.DataFrame(columns=['反省'])
+
+def get_summary_cube():
+    version = st.session_state.get('data_version', 0)
+    cube = st.session_state.get('summary_cube')
+    if cube is None or cube['version'] != version:
+        with tracer.span("summary_cube", files=len(st.session_state['clean_parts'])):
+            cube = build_summary_cube(get_unit_file_rollup())
+        cube['version'] = version
+        st.session_state['summary_cube'] = cube
+    return cube
+
+# ---------------------------------------------------------
+# 🧩 特訓問題の生成 & ストック
+# ---------------------------------------------------------
+PRACTICE_MENUS = ["理科記述", "社会記述", "漢字", "リスニング", "証明問題"]
+PROOF_GENRES = ["合同の証明", "相似の証明", "整数の性質の証明"]
+PROBLEM_POOL_SIZE = int(os.environ.get("JUKEN_PROBLEM_POOL_SIZE", "2"))   # メニューごとに作り置きする問題数
+PROBLEM_POOL_WORKERS = 2
+# 補充に失敗したメニューは、失敗が続くほど長く (この秒数から倍々、上限まで) 補充を止める
+PROBLEM_POOL_BACKOFF = float(os.environ.get("JUKEN_PROBLEM_POOL_BACKOFF", "30"))
+PROBLEM_POOL_BACKOFF_MAX = 600
+
+def generate_listening_problem():
+    # リスニング用プロンプト (JSONモード。形は LISTENING_SCHEMA で縛る)
+    p_lis = """
+    公立高校入試レベルの英語リスニング問題を1問作成してください。
+    新潟高校志望の生徒向けです。
+    
+    【各項目】
+    script: 英語のスクリプトのみ(A: ... B: ...)
+    question: 問題文(日本語)
+    options: 選択肢4つ
+    answer: 正解の選択肢 (options のいずれかと完全に同じ文字列)
+    explanation: 日本語訳と解説
+    """
+    data = ask_gemini_json(p_lis, LISTENING_SCHEMA, validate_listening, hedge="practice")
+    if not data: return None
+    prefetch_speech(data.get('script'))
+    return {
+        'script': data.get('script'),
+        'question': data.get('question'),
+        'options': data.get('options', []),
+        'answer': data.get('answer'),
+        'explanation': data.get('explanation'),
+        'type': 'listening'
+    }
+
+def generate_normal_problem(train_menu, sub_genre=""):
+    target_menu_name = f"数学の{sub_genre}" if sub_genre else train_menu
+    p_normal = f"""
+    公立高校入試レベルの「{target_menu_name}」の問題を1問作成してください。
+    
+    【各項目】
+    question: 問題文のみ
+    answer: 模範解答と解説
+    """
+    data = ask_gemini_json(p_normal, PRACTICE_SCHEMA, validate_practice, hedge="practice")
+    if not data: return None
+    return {
+        'question': data['question'].strip(),
+        'answer': data['answer'].strip(),
+        'type': 'normal',
+        'sub_genre': sub_genre # 証明の場合のジャンル名保持用
+    }
+
+def is_valid_problem(data):
+    if not data: return False
+    if data.get('type') == 'listening':
+        options = data.get('options')
+        return bool(data.get('script') and data.get('question')) and isinstance(options, list) and len(options) >= 2 and data.get('answer') in options
+    return bool(data.get('question') and data.get('answer'))
+
+def pool_key(train_menu, sub_genre=""):
+    return f"{train_menu}/{sub_genre}" if sub_genre else train_menu
+
+def generate_for_key(key):
+    train_menu, _, sub_genre = key.partition("/")
+    if train_menu == "リスニング": return generate_listening_problem()
+    return generate_normal_problem(train_menu, sub_genre)
+
+class ProblemPool:
+    # メニューごとに検証済みの問題を作り置きし、取り出されたらバックグラウンドで補充する (プロセス全体で共有)
+    def __init__(self, generate, size=PROBLEM_POOL_SIZE, workers=PROBLEM_POOL_WORKERS):
+        self.generate = generate
+        self.size = size
+        self._items = {}
+        self._pending = {}
+        self._failures = {}   # キー → (連続失敗回数, 次に補充してよい時刻)
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="problem-pool")
+
+    def _produce(self, key):
+        item = None
+        try: item = self.generate(key)
+        except Exception: pass
+        with self._lock:
+            self._pending[key] -= 1
+            if is_valid_problem(item):
+                self._items.setdefault(key, deque()).append(item)
+                self._failures.pop(key, None)
+            else:
+                n = self._failures.get(key, (0, 0))[0] + 1
+                self._failures[key] = (n, time.monotonic() + min(PROBLEM_POOL_BACKOFF_MAX, PROBLEM_POOL_BACKOFF * 2 ** (n - 1)))
+
+    def refill(self, key):
+        with self._lock:
+            # 失敗が続いているキーは、待ち時間が過ぎるまで (どのセッションからでも) 作り直さない
+            if time.monotonic() < self._failures.get(key, (0, 0))[1]: return
+            missing = self.size - len(self._items.get(key, ())) - self._pending.get(key, 0)
+            if missing <= 0: return
+            self._pending[key] = self._pending.get(key, 0) + missing
+        for _ in range(missing): self._executor.submit(self._produce, key)
+
+    def take(self, key):
+        with self._lock:
+            items = self._items.get(key)
+            item = items.popleft() if items else None
+        self.refill(key)
+        return item
+
+    def level(self, key):
+        with self._lock: return len(self._items.get(key, ()))
+
+@st.cache_resource(show_spinner=False)
+def get_problem_pool(_generate):
+    return ProblemPool(_generate)
+
+problem_pool = get_problem_pool(generate_for_key)
+
+def menu_pool_keys(train_menu):
+    if train_menu == "証明問題": return [pool_key(train_menu, g) for g in PROOF_GENRES]
+    return [pool_key(train_menu)]
+
+# ---------------------------------------------------------
+# 📚 まとめて採点
+# ---------------------------------------------------------
+BATCH_GRADE_WORKERS = 3
+BATCH_IMAGE_EXTS = ('.jpg', '.jpeg', '.png')
+SCORE_PATTERN = re.compile(r'SCORE\s*[:：]\s*([\d.]+)\s*/\s*([\d.]+)')
+
+def grading_prompt(has_solution, with_score=False):
+    prompt_v = "新潟高校志望の生徒の答案採点依頼。"
+    if has_solution:
+        prompt_v += "3枚目の画像は正解・解説です。これを基準に厳密に採点・添削してください。"
+    else:
+        prompt_v += "正解画像がありません。1枚目の問題画像をあなたが解き、その正解に基づいて2枚目の生徒の解答を採点・添削してください。"
+    if with_score: prompt_v += "\n最後の行に必ず「SCORE: 得点/満点」の形式で点数を書いてください。"
+    return prompt_v
+
+def collect_answer_images(files):
+    # 画像とzipを (キー, 名前, バイト列) のリストにする。
+    # 同じ名前の画像 (直接とzip内など) が上書きし合わないよう、キーには通し番号を付ける
+    items = []
+    for f in files:
+        if f.name.lower().endswith('.zip'):
+            with zipfile.ZipFile(io.BytesIO(f.getvalue())) as zf:
+                for info in zf.infolist():
+                    if info.is_dir() or info.filename.startswith('__MACOSX') or not info.filename.lower().endswith(BATCH_IMAGE_EXTS): continue
+                    items.append((info.filename, zf.read(info)))
+        else: items.append((f.name, f.getvalue()))
+    return [(f"{i}: {name}", name, raw) for i, (name, raw) in enumerate(items, 1)]
+
+def grade_answer(prompt, problem, answer, solution=None):
+    res = ask_gemini_robust(prompt, [problem, answer] + ([solution] if solution else []), cache_site="grade")
+    if res.startswith("エラー") or res.startswith("❌"): raise RuntimeError(res)
+    m = SCORE_PATTERN.search(res)
+    score, full = (float(m.group(1)), float(m.group(2))) if m else (None, None)
+    return {'得点': score, '満点': full, '得点率(%)': round(score / full * 100, 1) if m and full else None, '講評': res}
+
+def grade_answer_image(prompt, problem, raw, mode, solution=None):
+    # 画像の変換も採点スレッドで行う (読めない画像はその1件だけ失敗にする)
+    return grade_answer(prompt, problem, prepare_image_bytes(raw, mode)[0], solution)
+
+def batch_table(results):
+    df = pd.DataFrame(list(results.values()), columns=['ファイル名', '状態', '得点', '満点', '得点率(%)', '講評'])
+    df['要約'] = df['講評'].fillna("").str.replace(r'\s+', ' ', regex=True).str.slice(0, 60)
+    return df
+
+def run_batch_grading(targets, problem, solution, mode):
+    # targets: [(キー, 名前, バイト列)]。共通の問題・正解画像に対して並列に採点し、1件ずつ結果を反映する
+    results = st.session_state['batch_results']
+    prompt = grading_prompt(solution is not None, with_score=True)
+    for key, name, _ in targets: results[key] = {'ファイル名': name, '状態': '待機中'}
+    progress = st.progress(0.0, text=f"0/{len(targets)} 件完了")
+    table = st.empty()
+    table.dataframe(batch_table(results)[['ファイル名', '状態']], use_container_width=True, hide_index=True)
+    with ThreadPoolExecutor(max_workers=min(BATCH_GRADE_WORKERS, len(targets))) as pool:
+        futures = {pool.submit(grade_answer_image, prompt, problem, raw, mode, solution): key for key, _, raw in targets}
+        for i, fut in enumerate(as_completed(futures), 1):
+            key = futures[fut]
+            try: results[key].update(fut.result(), 状態='完了')
+            except Exception as e: results[key].update(状態='失敗', 講評=str(e))
+            progress.progress(i / len(futures), text=f"{i}/{len(futures)} 件完了")
+            table.dataframe(batch_table(results)[['ファイル名', '状態', '得点率(%)']], use_container_width=True, hide_index=True)
+    table.empty()
+
+# ---------------------------------------------------------
+# 📝 復習 (アドバイス & 確認テスト)
+# ---------------------------------------------------------
+REVIEW_WORKERS = 4   # 確認テストを裏で作るスレッド数 (プロセス全体)
+
+def advice_prompt(sel_sub, sel_top, rate, ref_text):
+    # プロンプト修正: 大局7割、反省3割
+    return f"""
+    新潟高校志望の受験生への指導。
+    
+    対象単元: {sel_sub}の「{sel_top}」
+    得点率: {rate}%
+    本人の反省メモ: {ref_text}
+    
+    【回答の構成比率】
+    ・全体の70%：この単元「{sel_top}」における新潟高校入試を見据えた重要ポイント、頻出パターン、大局的な学習指針。
+    ・全体の30%：本人の反省メモに基づいた具体的な改善アドバイス。
+    
+    上記バランスを意識して、具体的な復習法とチェック項目3つを教えてください。
+    """
+
+def difficulty_for(rate):
+    # 得点率から確認テストの難しさを決める (判定の色と同じ区切り)
+    if rate <= 50: return "基礎"
+    elif rate <= 70: return "標準"
+    else: return "発展"
+
+def test_prompt(sel_sub, sel_top, ref_text, difficulty="標準"):
+    # プロンプト修正: 単元の本質的な問題を重視
+    return f"""
+    新潟高校入試レベルの実践問題作成。
+    単元: {sel_sub}の「{sel_top}」
+    難易度: {difficulty} (基礎=教科書の確認 / 標準=入試の標準問題 / 発展=合否を分ける問題)
+    
+    【作成指針】
+    1. 反省メモ（{ref_text}）の内容だけに偏らず、この単元の本質的な理解を問う良問を作成してください。
+    2. ただし、解説の中で反省点にも触れ、なぜ間違えやすいのかを補足してください。
+    3. 解答・解説付き。
+    """
+
+@st.cache_resource(show_spinner=False)
+def get_review_executor():
+    return ThreadPoolExecutor(max_workers=REVIEW_WORKERS, thread_name_prefix="review")
+
+def is_valid_test(text):
+    return bool(text and text.strip()) and not text.startswith(("エラー", "❌")) and "\n\nエラー:" not in text
+
+# ---------------------------------------------------------
+# 📚 問題ライブラリ (生成した確認テスト・特訓問題の再利用)
+# ---------------------------------------------------------
+# 検証を通った確認テスト・特訓問題を 種別・教科・単元・メニュー・難易度 の索引付きで全生徒共通に保存し、
+# 同じ単元を学ぶ人にはまだ見ていないものから出す。生成はライブラリに無い時だけ (プロンプト単位のキャッシュとは別)。
+# 単元名が少し違うもの (「一次関数の利用」と「一次関数」など) は全文検索 (FTS5 trigram) で拾う。
+# JUKEN_LIBRARY_DB を空にすると無効
+LIBRARY_DB_PATH = os.environ.get("JUKEN_LIBRARY_DB", os.path.join(CACHE_DIR, "library.sqlite3"))
+# サイドバーに管理用の表 (在庫・ヒット率・全文検索) を出す。未指定なら診断パネルと同じ
+LIBRARY_ADMIN = os.environ.get("JUKEN_LIBRARY_ADMIN", "1" if DIAGNOSTICS else "") not in ("", "0")
+LIBRARY_FTS_MIN_CHARS = 3   # trigram は3文字未満の語を検索できない
+# 特訓メニュー → 教科
+PRACTICE_SUBJECTS = {"理科記述": "理科", "社会記述": "社会", "漢字": "国語", "リスニング": "英語", "証明問題": "数学"}
+
+class ProblemLibrary:
+    def __init__(self, path):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute("CREATE TABLE IF NOT EXISTS items (id INTEGER PRIMARY KEY, kind TEXT, subject TEXT, unit TEXT, menu TEXT, difficulty TEXT, "
+                         "body TEXT, digest TEXT UNIQUE, created REAL, served INTEGER DEFAULT 0)")
+        self._db.execute("CREATE INDEX IF NOT EXISTS idx_items_topic ON items(kind, subject, menu, difficulty, unit)")
+        self._db.execute("CREATE TABLE IF NOT EXISTS seen (viewer TEXT, item INTEGER, at REAL, PRIMARY KEY (viewer, item))")
+        self._db.execute("CREATE TABLE IF NOT EXISTS lookups (kind TEXT, menu TEXT, subject TEXT, hits INTEGER, misses INTEGER, PRIMARY KEY (kind, menu, subject))")
+        # FTS5 (trigram) が使えないSQLiteでは、単元名の完全一致だけで探す
+        try:
+            self._db.execute("CREATE VIRTUAL TABLE IF NOT EXISTS items_fts USING fts5(unit, body, content='items', content_rowid='id', tokenize='trigram')")
+            self.fts = True
+        except sqlite3.OperationalError: self.fts = False
+        self._db.commit()
+
+    def add(self, kind, subject, unit, menu, difficulty, body, viewer=None):
+        # 同じ本文は1回だけ保存する。viewer を渡すと、その人は見た扱いにする
+        digest = hashlib.sha256(f"{kind}\0{body}".encode('utf-8')).hexdigest()
+        with self._lock:
+            cur = self._db.execute("INSERT OR IGNORE INTO items (kind, subject, unit, menu, difficulty, body, digest, created) VALUES (?,?,?,?,?,?,?,?)",
+                                   (kind, subject, unit, menu, difficulty, body, digest, time.time()))
+            if cur.rowcount:
+                item = cur.lastrowid
+                if self.fts: self._db.execute("INSERT INTO items_fts (rowid, unit, body) VALUES (?,?,?)", (item, unit, body))
+            else: item = self._db.execute("SELECT id FROM items WHERE digest=?", (digest,)).fetchone()[0]
+            if viewer: self._db.execute("INSERT OR IGNORE INTO seen VALUES (?,?,?)", (viewer, item, time.time()))
+            self._db.commit()
+        return item
+
+    def _find(self, viewer, kind, subject, unit, menu, difficulty):
+        # 1) 同じ単元で未出題のもの 2) 無ければ全文検索で名前の近い単元のもの。出題回数の少ない順
+        topic = (kind, subject, menu, difficulty)
+        unseen = "i.id NOT IN (SELECT item FROM seen WHERE viewer=?)"
+        row = self._db.execute(f"SELECT i.id, i.body FROM items i WHERE i.kind=? AND i.subject=? AND i.menu=? AND i.difficulty=? AND i.unit=? AND {unseen} "
+                               "ORDER BY i.served, i.id LIMIT 1", (*topic, unit, viewer)).fetchone()
+        if row or not self.fts or len(unit) < LIBRARY_FTS_MIN_CHARS: return row
+        query = 'unit : "' + unit.replace('"', '""') + '"'
+        return self._db.execute(f"SELECT i.id, i.body FROM items_fts JOIN items i ON i.id = items_fts.rowid WHERE items_fts MATCH ? "
+                                f"AND i.kind=? AND i.subject=? AND i.menu=? AND i.difficulty=? AND {unseen} ORDER BY rank, i.served LIMIT 1",
+                                (query, *topic, viewer)).fetchone()
+
+    def has_unseen(self, viewer, kind, subject, unit, menu, difficulty):
+        with self._lock: return self._find(viewer, kind, subject, unit, menu, difficulty) is not None
+
+    def record(self, kind, menu, subject, hit):
+        with self._lock:
+            self._db.execute("INSERT INTO lookups VALUES (?,?,?,?,?) ON CONFLICT (kind, menu, subject) DO UPDATE SET hits=hits+excluded.hits, misses=misses+excluded.misses",
+                             (kind, menu, subject, int(hit), int(not hit)))
+            self._db.commit()
+
+    def take(self, viewer, kind, subject, unit, menu, difficulty):
+        # 未出題のものを1つ出して見た扱いにする。無ければ None (ヒット・ミスはここで数える)
+        with self._lock:
+            row = self._find(viewer, kind, subject, unit, menu, difficulty)
+            if row:
+                self._db.execute("UPDATE items SET served=served+1 WHERE id=?", (row[0],))
+                self._db.execute("INSERT OR IGNORE INTO seen VALUES (?,?,?)", (viewer, row[0], time.time()))
+                self._db.commit()
+        self.record(kind, menu, subject, row is not None)
+        return row[1] if row else None
+
+    def stats(self):
+        # 種別・メニュー・教科ごとの在庫とヒット率 (管理用)
+        with self._lock:
+            stock = {(k, m, s): (n, served) for k, m, s, n, served in
+                     self._db.execute("SELECT kind, menu, subject, COUNT(*), SUM(served) FROM items GROUP BY kind, menu, subject")}
+            lookups = {(k, m, s): (h, miss) for k, m, s, h, miss in self._db.execute("SELECT kind, menu, subject, hits, misses FROM lookups")}
+        rows = []
+        for key in sorted(set(stock) | set(lookups)):
+            n, served = stock.get(key, (0, 0))
+            hits, misses = lookups.get(key, (0, 0))
+            rows.append({'種別': key[0], 'メニュー': key[1], '教科': key[2], '在庫': n, '出題回数': served or 0,
+                         'ヒット': hits, 'ミス': misses, 'ヒット率(%)': round(hits / (hits + misses) * 100, 1) if hits + misses else 0.0})
+        return rows
+
+    def search(self, text, limit=20):
+        # 管理画面の全文検索 (FTSが無い・短すぎる語は LIKE)
+        with self._lock:
+            if self.fts and len(text) >= LIBRARY_FTS_MIN_CHARS:
+                sql = ("SELECT i.kind, i.subject, i.unit, i.menu, i.difficulty, i.served, i.body FROM items_fts JOIN items i ON i.id = items_fts.rowid "
+                       "WHERE items_fts MATCH ? ORDER BY rank LIMIT ?")
+                rows = self._db.execute(sql, ('"' + text.replace('"', '""') + '"', limit)).fetchall()
+            else:
+                rows = self._db.execute("SELECT kind, subject, unit, menu, difficulty, served, body FROM items WHERE unit LIKE ? OR body LIKE ? ORDER BY id DESC LIMIT ?",
+                                        (f"%{text}%", f"%{text}%", limit)).fetchall()
+        return [{'種別': k, '教科': s, '単元': u, 'メニュー': m, '難易度': d, '出題回数': n, '冒頭': re.sub(r'\s+', ' ', b)[:60]} for k, s, u, m, d, n, b in rows]
+
+@st.cache_resource(show_spinner=False)
+def get_problem_library():
+    if not LIBRARY_DB_PATH: return None
+    try: return ProblemLibrary(LIBRARY_DB_PATH)
+    except: return None
+
+problem_library = get_problem_library()
+
+def library_viewer():
+    # 「見た」の判定に使うID。ログイン中は生徒ID、それ以外はセッションごと
+    if st.session_state.get('student_id'): return f"student:{st.session_state['student_id']}"
+    if 'library_viewer' not in st.session_state: st.session_state['library_viewer'] = f"session:{random.getrandbits(48):012x}"
+    return st.session_state['library_viewer']
+
+def practice_topic(train_menu, sub_genre=""):
+    # 特訓問題の索引 (教科, 単元, メニュー, 難易度)。特訓は入試の標準問題なので難易度は固定
+    return PRACTICE_SUBJECTS.get(train_menu, "その他"), sub_genre or train_menu, train_menu, "標準"
+
+def take_practice_from_library(train_menu, sub_genre=""):
+    if not problem_library: return None
+    body = problem_library.take(library_viewer(), "practice", *practice_topic(train_menu, sub_genre))
+    return dict(json.loads(body), source="library") if body else None
+
+def save_practice_to_library(data, train_menu, sub_genre=""):
+    if not problem_library or not is_valid_problem(data): return
+    body = json.dumps({k: v for k, v in data.items() if k not in ('source', 'check_result')}, ensure_ascii=False)
+    problem_library.add("practice", *practice_topic(train_menu, sub_genre), body, viewer=library_viewer())
+
 # ---------------------------------------------------------
 # 🖥️ サイドバー
 # ---------------------------------------------------------
-with st.sidebar:
+@traced_fragment("sidebar")
+def render_sidebar():
+    # サイドバーの操作はサイドバーだけ再実行する (データを入れ替える操作は st.rerun() で全体を再実行)
+    if student_store:
+        st.subheader("👤 生徒")
+        current = st.session_state.get('student_id')
+        if current: st.caption(f"ログイン中: **{current}** (保存済み {len(st.session_state['student_sync']['keys'])}ファイル)")
+        with st.form("student"):
+            sid = st.text_input("生徒ID", current or "", help="IDだけで切り替わります (パスワードなし)。信頼できるネットワーク内でのみ使ってください")
+            if st.form_submit_button("切り替え") and sid.strip() and sid.strip() != current:
+                switch_student(sid.strip())
+                st.rerun()
+        if current and st.button("ログアウト"):
+            switch_student(None)
+            st.rerun()
+        st.divider()
+
     st.subheader("📲 データ管理")
     sync_tab1, sync_tab2 = st.tabs(["📤 保存", "📥 復元"])
     with sync_tab1:
         if st.session_state['data_store'] or st.session_state['textbooks']:
-            safe_cat = {f"{k[0]}:{k[1]}" if isinstance(k, tuple) else str(k): v for k, v in st.session_state['category_map'].items()}
-            safe_ds = {n: df.to_json(orient='split', force_ascii=False, date_format='iso') for n, df in st.session_state['data_store'].items()}
-            backup = {'textbooks': st.session_state['textbooks'], 'data_store': safe_ds, 'category_map': safe_cat}
-            code = compress_data_to_code(backup)
-            if code:
-                st.download_button("💾 ファイル保存", code, f"niigata_bk_{today}.txt", "text/plain", type="primary")
-                with st.expander("コード表示"): st.code(code)
+            # バックアップはボタンを押した時だけ作る
+            c_full, c_diff = st.columns(2)
+            if c_full.button("💾 バックアップ作成", type="primary"):
+                st.session_state['backup_blob'] = make_backup('full')
+            if st.session_state.get('backup_base') and c_diff.button("➕ 差分のみ"):
+                st.session_state['backup_blob'] = make_backup('delta')
+            blob = st.session_state.get('backup_blob')
+            if blob and blob['version'] == st.session_state.get('data_version', 0):
+                label = "差分" if blob['kind'] == 'delta' else "完全"
+                st.caption(f"{label}バックアップ: {blob['files']}ファイル / {len(blob['data']) // 1024 + 1}KB")
+                st.download_button("⬇️ ファイル保存", blob['data'], blob['file_name'], "application/octet-stream")
+                if st.checkbox("コード表示"): st.code(base64.b64encode(blob['data']).decode('ascii'))
     with sync_tab2:
-        up_file = st.file_uploader("ファイル", type=['txt'])
+        up_files = st.file_uploader("ファイル (完全 + 差分)", type=['ngb', 'txt'], accept_multiple_files=True)
         up_text = st.text_area("コード")
         if st.button("復元"):
-            target = up_file.read().decode() if up_file else up_text.strip()
-            data = decompress_code_to_data(target)
-            if data:
-                try:
-                    st.session_state['textbooks'] = data.get('textbooks', {})
-                    st.session_state['category_map'] = {(k.split(':',1)[0], k.split(':',1)[1]) if ':' in k else (k,k): v for k, v in data.get('category_map', {}).items()}
-                    st.session_state['data_store'] = {n: pd.read_json(j, orient='split') for n, j in data.get('data_store', {}).items()}
-                    st.session_state['clean_df'] = pd.DataFrame()
-                    st.rerun()
-                except: st.error("復元失敗")
+            blobs = [f.getvalue() for f in up_files] if up_files else [up_text.strip().encode('utf-8')]
+            try:
+                restore_backups(blobs)
+                restored = True
+            except Exception as e:
+                restored = False
+                st.error(f"復元失敗: {e}")
+            if restored: st.rerun()
     
     st.divider()
     st.subheader("📚 参考書")
@@ -371,9 +2303,56 @@ with st.sidebar:
     
     st.divider()
     if st.button("🚨 全データ削除"):
-        st.session_state['data_store']={}; st.session_state['clean_df']=pd.DataFrame(); st.session_state['practice_data']={}
+        st.session_state['data_store']={}; st.session_state['practice_data']={}
+        reset_analysis()
         st.rerun()
 
+    mem = session_memory_report()
+    st.caption(f"🧮 このセッションのデータ: 元データ {mem['data_store'] / 2**20:.1f}MB / 解析済み {mem['clean_parts'] / 2**20:.1f}MB")
+    api = gemini_client.stats()
+    if api['requests']: st.caption(f"🚦 API: 待機中 {api['queue_depth']}件 / 平均待ち {api['wait_avg']:.1f}秒 (p90 {api['wait_p90']:.1f}秒) / 再試行 {api['retries']}回 / 相乗り {api['coalesced']}回")
+    for site, h in gemini_client.hedge_stats().items():
+        wins = " / ".join(f"{'Pro' if w == 'pro' else 'Flash' if w == 'flash' else '失敗'} {n}回 (p90 {h['latency'][w]['p90']:.1f}秒)" for w, n in h['wins'].items())
+        st.caption(f"🏁 ヘッジ [{site}]: {h['calls']}回中 {h['hedged']}回 Flashにも依頼 ・ {wins}")
+    ttft = ttft_log.summary()
+    if ttft: st.caption(f"⏱️ 表示開始までの時間: 平均 {ttft['avg']:.1f}秒 / p90 {ttft['p90']:.1f}秒 ({ttft['count']}件)")
+    if response_cache:
+        cs = response_cache.stats()
+        st.caption(f"🗄️ AIキャッシュ: ヒット {cs['hits']} / ミス {cs['misses']} ({cs['hit_rate']}%) ・ {cs['entries']}件 {cs['bytes'] // 1024}KB")
+    library_stats = problem_library.stats() if problem_library else []
+    if library_stats:
+        hits, misses = sum(r['ヒット'] for r in library_stats), sum(r['ミス'] for r in library_stats)
+        rate = f" ({hits / (hits + misses) * 100:.1f}%)" if hits + misses else ""
+        st.caption(f"📚 問題ライブラリ: {sum(r['在庫'] for r in library_stats)}問 ・ 再利用 {hits} / 新規生成 {misses}{rate}")
+
+    if tracer.enabled:
+        with st.expander("🩺 診断"):
+            # サイドバーは再実行の途中で描かれるので、表示するのは前回の再実行の内訳
+            prev = f"{st.session_state['diag_session']}:{st.session_state['diag_run'] - 1}"
+            spans = pd.DataFrame(tracer.records(prev))
+            if not spans.empty:
+                total = spans.loc[spans['span'] == 'rerun', 'ms']
+                st.caption(f"前回の再実行: {total.iloc[-1] if len(total) else '-'}ms")
+                st.dataframe(spans.drop(columns=['ts', 'run']), use_container_width=True, hide_index=True)
+            summary = tracer.summary()
+            if not summary.empty:
+                st.caption("全セッションの集計")
+                st.dataframe(summary, use_container_width=True, hide_index=True)
+                log = "\n".join(json.dumps(r, ensure_ascii=False, default=str) for r in tracer.records())
+                st.download_button("⬇️ 計測ログ (JSON Lines)", log, "juken_spans.jsonl", "application/json")
+
+    if LIBRARY_ADMIN and library_stats:
+        with st.expander("📚 問題ライブラリ (管理)"):
+            st.caption("種別・メニュー・教科ごとの在庫とヒット率 (全生徒)")
+            st.dataframe(pd.DataFrame(library_stats), use_container_width=True, hide_index=True)
+            query = st.text_input("全文検索 (単元・本文)", key="library_query")
+            if query.strip():
+                found = problem_library.search(query.strip())
+                if found: st.dataframe(pd.DataFrame(found), use_container_width=True, hide_index=True)
+                else: st.caption("見つかりませんでした")
+
+with st.sidebar: render_sidebar()
+
 # ---------------------------------------------------------
 # 📂 メイン画面
 # ---------------------------------------------------------
@@ -384,286 +2363,308 @@ with col_up:
 with col_btn:
     if st.button("🚀 AI解析", type="primary", use_container_width=True):
         if uploaded_files:
-            for file in uploaded_files:
-                df = parse_csv(file)
-                if df is not None: st.session_state['data_store'][file.name] = df
+            frames, errors, skipped = parse_csv_files(uploaded_files, known=st.session_state['data_store'])
+            add_to_data_store(frames)
+            for name, msg in errors.items(): st.error(f"⚠️ {name}: {msg}")
+            if skipped: st.caption(f"変更のないファイル {skipped}件 はスキップしました")
             process_and_categorize()
         elif st.session_state['data_store']: process_and_categorize()
         else: st.warning("ファイルを選択してください")
 
-if not st.session_state['clean_df'].empty:
-    df_show = st.session_state['clean_df']
-    st.markdown("---")
-    
-    tab1, tab2, tab3, tab4 = st.tabs(["📊 全体分析", "📖 復習＆テスト", "📷 画像採点", "🧩 その他特訓"])
+# タブごとの画面。操作したタブだけを再実行する (データが変わる操作は全体を再実行)
+# ------------------
+# TAB 1: 分析
+# ------------------
+@traced_fragment("tab1")
+def render_analysis_tab(cube):
+    # 🚨 緊急復習リスト (集計は build_summary_cube で済んでいる)
+    urgent_df = cube['urgent']
+    if not urgent_df.empty:
+        st.markdown('<div class="urgent-box">', unsafe_allow_html=True)
+        st.subheader("🚨 教科別：早急に復習すべき単元")
+        st.caption("理科・社会はワースト5、その他はワースト2を表示しています。")
+        st.dataframe(
+            urgent_df[['教科', '内容', '得点率(%)', '判定']],
+            column_config={
+                "得点率(%)": st.column_config.ProgressColumn(format="%.1f%%", min_value=0, max_value=100)
+            },
+            use_container_width=True, hide_index=True
+        )
+        st.markdown('</div>', unsafe_allow_html=True)
 
-    # ------------------
-    # TAB 1: 分析
-    # ------------------
-    with tab1:
-        # 集計
-        summary = df_show.groupby(['教科', '内容'])[['点数', '配点']].sum().reset_index()
-        summary['得点率(%)'] = (summary['点数'] / summary['配点'] * 100).fillna(0).round(1)
-        summary['判定'] = summary['得点率(%)'].apply(get_status_emoji)
-        
-        # 🚨 緊急復習リスト抽出ロジック
-        urgent_list = []
-        for subj in summary['教科'].unique():
-            limit = 5 if subj in ['理科', '社会'] else 2
-            # 得点率が低い順に取得
-            worst = summary[summary['教科'] == subj].sort_values('得点率(%)').head(limit)
-            if not worst.empty:
-                urgent_list.append(worst)
-        
-        if urgent_list:
-            urgent_df = pd.concat(urgent_list)
-            st.markdown('<div class="urgent-box">', unsafe_allow_html=True)
-            st.subheader("🚨 教科別：早急に復習すべき単元")
-            st.caption("理科・社会はワースト5、その他はワースト2を表示しています。")
-            st.dataframe(
-                urgent_df[['教科', '内容', '得点率(%)', '判定']],
-                column_config={
-                    "得点率(%)": st.column_config.ProgressColumn(format="%.1f%%", min_value=0, max_value=100)
-                },
-                use_container_width=True, hide_index=True
-            )
-            st.markdown('</div>', unsafe_allow_html=True)
-
-        c1, c2 = st.columns([2, 1])
-        with c1:
-            st.subheader("全教科ワーストランキング")
-            st.dataframe(summary.sort_values('得点率(%)').head(10)[['教科','内容','判定','得点率(%)']], use_container_width=True, hide_index=True)
-        with c2:
-            st.subheader("教科別平均")
-            sub_sum = df_show.groupby('教科')[['点数', '配点']].sum().reset_index()
-            sub_sum['得点率(%)'] = (sub_sum['点数']/sub_sum['配点']*100).fillna(0).round(1)
-            st.dataframe(sub_sum[['教科','得点率(%)']], use_container_width=True, hide_index=True)
-
-    # ------------------
-    # TAB 2: 復習
-    # ------------------
-    with tab2:
-        st.subheader("AI家庭教師")
-        summary_t2 = df_show.groupby(['教科', '内容'])[['点数', '配点']].sum().reset_index()
-        summary_t2['得点率(%)'] = (summary_t2['点数']/summary_t2['配点']*100).fillna(0).round(1)
-        
-        c1, c2 = st.columns(2)
-        sel_sub = c1.selectbox("教科", summary_t2['教科'].unique())
-        
-        sub_topics = summary_t2[summary_t2['教科']==sel_sub].sort_values('得点率(%)')
-        topic_map = {f"{get_status_emoji(row['得点率(%)'])} {row['内容']} ({row['得点率(%)']}%)": row['内容'] for _, row in sub_topics.iterrows()}
-        sel_top_d = c2.selectbox("単元", list(topic_map.keys()))
-        sel_top = topic_map[sel_top_d]
-        
-        target_rows = df_show[(df_show['教科']==sel_sub) & (df_show['内容']==sel_top)]
-        rate = (target_rows['点数'].sum() / target_rows['配点'].sum() * 100).round(1)
-        reflections = [str(r) for r in target_rows['反省'].unique() if r and r!="nan"]
-        ref_text = "\n".join([f"- {r}" for r in reflections]) if reflections else "特になし"
-        
-        st.info(f"得点率: {rate}%")
-        if reflections: st.info(f"📝 反省メモ:\n{ref_text}")
-        
-        if st.button("① アドバイスを聞く"):
-            # プロンプト修正: 大局7割、反省3割
-            prompt = f"""
-            新潟高校志望の受験生への指導。
-            
-            対象単元: {sel_sub}の「{sel_top}」
-            得点率: {rate}%
-            本人の反省メモ: {ref_text}
-            
-            【回答の構成比率】
-            ・全体の70%：この単元「{sel_top}」における新潟高校入試を見据えた重要ポイント、頻出パターン、大局的な学習指針。
-            ・全体の30%：本人の反省メモに基づいた具体的な改善アドバイス。
-            
-            上記バランスを意識して、具体的な復習法とチェック項目3つを教えてください。
-            """
-            st.session_state['guide'] = ask_gemini_robust(prompt)
-        
-        if 'guide' in st.session_state:
-            st.markdown(st.session_state['guide'])
-            if st.button("② 確認テスト作成"):
-                # プロンプト修正: 単元の本質的な問題を重視
-                prompt = f"""
-                新潟高校入試レベルの実践問題作成。
-                単元: {sel_sub}の「{sel_top}」
-                
-                【作成指針】
-                1. 反省メモ（{ref_text}）の内容だけに偏らず、この単元の本質的な理解を問う良問を作成してください。
-                2. ただし、解説の中で反省点にも触れ、なぜ間違えやすいのかを補足してください。
-                3. 解答・解説付き。
-                """
-                st.session_state['test'] = ask_gemini_robust(prompt)
-        
-        if 'test' in st.session_state:
+    c1, c2 = st.columns([2, 1])
+    with c1:
+        st.subheader("全教科ワーストランキング")
+        st.dataframe(cube['ranked'].head(10)[['教科','内容','判定','得点率(%)']], use_container_width=True, hide_index=True)
+    with c2:
+        st.subheader("教科別平均")
+        st.dataframe(cube['subject'][['教科','得点率(%)']], use_container_width=True, hide_index=True)
+
+    # 📈 模試ごとの推移 (指標は build_summary_cube で計算済み、グラフは版ごとにキャッシュ)
+    trend = cube['trend']
+    if trend.empty: return
+    st.subheader("📈 模試ごとの推移")
+    subjects = list(dict.fromkeys(trend['教科'].astype(str)))
+    sel_sub = st.selectbox("教科", subjects, key="trend_subject")
+    rows = trend[trend['教科'] == sel_sub].sort_values('伸び(pt/回)', kind='stable')
+    st.caption(f"伸び: 1回あたりの得点率の変化 (回帰の傾き) / ばらつき: 回ごとの得点率の標準偏差 / 直近: 最新{TREND_LAST_N}回の得点率")
+    st.dataframe(rows[['内容', '回数', '直近(%)', '伸び(pt/回)', 'ばらつき(pt)']], use_container_width=True, hide_index=True)
+    # 初期表示は伸びが最も悪い単元 (2回以上受けたもの)
+    worst = rows[rows['回数'] > 1]['内容'].astype(str).head(3).tolist()
+    units = st.multiselect("グラフに重ねる単元", rows['内容'].astype(str).tolist(), default=worst, max_selections=TREND_MAX_LINES, key=f"trend_units_{sel_sub}")
+    st.image(get_trend_chart(cube, sel_sub, units), use_container_width=True)
+
+# ------------------
+# TAB 2: 復習
+# ------------------
+@traced_fragment("tab2")
+def render_review_tab(cube):
+    st.subheader("AI家庭教師")
+    c1, c2 = st.columns(2)
+    sel_sub = c1.selectbox("教科", cube['subject']['教科'])
+    
+    sub_topics = cube['topics'][sel_sub]
+    topic_map = {f"{get_status_emoji(row['得点率(%)'])} {row['内容']} ({row['得点率(%)']}%)": row['内容'] for _, row in sub_topics.iterrows()}
+    sel_top_d = c2.selectbox("単元", list(topic_map.keys()))
+    sel_top = topic_map[sel_top_d]
+    
+    target_rows = unit_rows(cube, sel_sub, sel_top)
+    rate = sub_topics.loc[sub_topics['内容']==sel_top, '得点率(%)'].iloc[0]
+    reflections = [str(r) for r in target_rows['反省'].unique() if r and r!="nan"]
+    ref_text = "\n".join([f"- {r}" for r in reflections]) if reflections else "特になし"
+    
+    st.info(f"得点率: {rate}%")
+    if reflections: st.info(f"📝 反省メモ:\n{ref_text}")
+    
+    # 教科・単元が変わったら、前の単元のアドバイス・テストと裏で作っていたテストは捨てる
+    if st.session_state.get('review_key') != (sel_sub, sel_top):
+        job = st.session_state.pop('test_job', None)
+        if job: job.cancel()
+        st.session_state.pop('guide', None)
+        st.session_state.pop('test', None)
+        st.session_state['review_key'] = (sel_sub, sel_top)
+    speculate = st.checkbox("⚡ アドバイスと一緒に確認テストも作る", value=True, key="review_speculate")
+    # 確認テストの索引 (教科, 単元, メニュー, 難易度)
+    test_topic = (sel_sub, sel_top, "確認テスト", difficulty_for(rate))
+    
+    if st.button("① アドバイスを聞く"):
+        # ライブラリに未出題のテストがあれば、先回りして作らない (反省メモがあればメモを踏まえて作るので使わない)
+        in_library = problem_library and not reflections and problem_library.has_unseen(library_viewer(), "test", *test_topic)
+        if speculate and not in_library and 'test_job' not in st.session_state:
+            st.session_state['test_job'] = get_review_executor().submit(ask_gemini_robust, test_prompt(sel_sub, sel_top, ref_text, test_topic[3]), cache_site=None)
+        st.session_state['guide'] = render_gemini(advice_prompt(sel_sub, sel_top, rate, ref_text), cache_site="advice")
+    elif 'guide' in st.session_state:
+        st.markdown(st.session_state['guide'])
+    
+    if 'guide' in st.session_state:
+        job = st.session_state.get('test_job')
+        if job: st.caption("✅ 確認テストの準備ができています" if job.done() else "⏳ 確認テストを作成中...")
+        if st.button("② 確認テスト作成"):
+            st.markdown("---")
+            # 先回りしていなければ、まずライブラリの未出題のものから出す
+            stored = problem_library.take(library_viewer(), "test", *test_topic) if problem_library and not job and not reflections else None
+            if job:
+                if problem_library: problem_library.record("test", test_topic[2], sel_sub, hit=False)
+                with st.spinner("確認テストを仕上げ中..."): st.session_state['test'] = job.result()
+                del st.session_state['test_job']
+                st.markdown(st.session_state['test'])
+            elif stored:
+                st.caption("📚 ライブラリから出題しました (この単元用に作成済みのテスト)")
+                st.session_state['test'] = stored
+                st.markdown(stored)
+            else:
+                st.session_state['test'] = render_gemini(test_prompt(sel_sub, sel_top, ref_text, test_topic[3]), cache_site=None)
+            # 反省メモを元に作ったテストはその生徒の書いた内容を含むので、他の生徒と共有するライブラリには入れない
+            if problem_library and not stored and not reflections and is_valid_test(st.session_state['test']):
+                problem_library.add("test", *test_topic, st.session_state['test'], viewer=library_viewer())
+        elif 'test' in st.session_state:
             st.markdown("---")
             st.markdown(st.session_state['test'])
 
-    # ------------------
-    # TAB 3: 画像採点
-    # ------------------
-    with tab3:
-        st.subheader("📷 自由画像採点")
-        st.caption("正解画像は無くてもOKです。その場合AIが問題を解いて採点します。")
+# ------------------
+# TAB 3: 画像採点
+# ------------------
+@traced_fragment("tab3")
+def render_grading_tab():
+    st.subheader("📷 自由画像採点")
+    st.caption("正解画像は無くてもOKです。その場合AIが問題を解いて採点します。")
+    grade_style = st.radio("採点方法", ["1枚ずつ", "まとめて採点"], horizontal=True, key="grade_style")
+    img_mode = st.radio("画像モード", list(IMAGE_MODES), horizontal=True, key="grade_img_mode")
+    
+    if grade_style == "1枚ずつ":
         c1,c2,c3 = st.columns(3)
         img_p = c1.file_uploader("問題", type=['jpg','png'])
         img_u = c2.file_uploader("解答", type=['jpg','png'])
         img_a = c3.file_uploader("正解 (任意)", type=['jpg','png'])
         
         if img_p and img_u and st.button("採点開始"):
-            with st.spinner("AI先生が目で見て採点中..."):
-                imgs = [PIL.Image.open(img_p), PIL.Image.open(img_u)]
-                prompt_v = "新潟高校志望の生徒の答案採点依頼。"
-                if img_a:
-                    imgs.append(PIL.Image.open(img_a))
-                    prompt_v += "3枚目の画像は正解・解説です。これを基準に厳密に採点・添削してください。"
-                else:
-                    prompt_v += "正解画像がありません。1枚目の問題画像をあなたが解き、その正解に基づいて2枚目の生徒の解答を採点・添削してください。"
-                
-                res = ask_gemini_robust(prompt_v, imgs)
-                st.markdown(res)
-
-    # ------------------
-    # TAB 4: その他特訓
-    # ------------------
-    with tab4:
-        st.subheader("🧩 その他特訓（ランダム出題）")
-        st.caption("公立高校入試レベルの問題をランダムに出題します。")
+            imgs, original, sent = prepare_images([f for f in [img_p, img_u, img_a] if f], IMAGE_MODES[img_mode])
+            st.caption(image_savings_caption(original, sent))
+            prompt_v = grading_prompt(img_a is not None)
+            st.session_state['grade_result'] = render_gemini(prompt_v, imgs, cache_site="grade", spinner="AI先生が目で見て採点中...")
+        elif 'grade_result' in st.session_state:
+            st.markdown(st.session_state['grade_result'])
+    
+    else:
+        # 共通の問題・正解に対して、複数枚の答案 (画像 or zip) をまとめて採点
+        c1, c2 = st.columns(2)
+        b_prob = c1.file_uploader("問題 (共通)", type=['jpg','png'], key="batch_prob")
+        b_sol = c2.file_uploader("正解 (任意・共通)", type=['jpg','png'], key="batch_sol")
+        b_answers = st.file_uploader("解答 (複数の画像 または zip)", type=['jpg','jpeg','png','zip'], accept_multiple_files=True, key="batch_answers")
+        if 'batch_results' not in st.session_state: st.session_state['batch_results'] = {}
+        results = st.session_state['batch_results']
+        failed = [n for n, r in results.items() if r.get('状態') == '失敗']
         
-        train_menu = st.radio("メニューを選択", ["理科記述", "社会記述", "漢字", "リスニング", "証明問題"], horizontal=True)
+        cb1, cb2 = st.columns(2)
+        run_all = cb1.button("📚 まとめて採点開始", disabled=not (b_prob and b_answers))
+        run_failed = cb2.button(f"🔁 失敗分だけ再採点 ({len(failed)}件)", disabled=not (failed and b_prob and b_answers))
+        if run_all or run_failed:
+            mode = IMAGE_MODES[img_mode]
+            try:
+                problem = prepare_image_bytes(b_prob.getvalue(), mode)[0]
+                solution = prepare_image_bytes(b_sol.getvalue(), mode)[0] if b_sol else None
+            except Exception as e:
+                st.error(f"問題・正解の画像を読めません: {e}")
+            else:
+                answers = collect_answer_images(b_answers)
+                if run_all: results.clear()
+                targets = [(k, n, raw) for k, n, raw in answers if run_all or k in failed]
+                if targets: run_batch_grading(targets, problem, solution, mode)
+                else: st.warning("採点できる画像がありません")
         
-        if st.button("🎲 問題を作成する"):
-            # データリセット
-            st.session_state['practice_data'] = {}
-
-            with st.spinner("AIが出題中..."):
-                if train_menu == "リスニング":
-                    # リスニング用プロンプト (JSON出力)
-                    p_lis = """
-                    公立高校入試レベルの英語リスニング問題を1問作成してください。
-                    新潟高校志望の生徒向けです。
-                    
-                    【厳守】以下のJSON形式のみを出力してください。Markdownのコードブロックは不要です。
-                    {
-                        "script": "英語のスクリプトのみ(A: ... B: ...)",
-                        "question": "問題文(日本語)",
-                        "options": ["選択肢1", "選択肢2", "選択肢3", "選択肢4"],
-                        "answer": "正解の選択肢文字列",
-                        "explanation": "日本語訳と解説"
-                    }
-                    """
-                    res = ask_gemini_robust(p_lis)
-                    
-                    try:
-                        json_match = re.search(r'\{.*\}', res, re.DOTALL)
-                        if json_match:
-                            data = json.loads(json_match.group())
-                            st.session_state['practice_data'] = {
-                                'script': data.get('script'),
-                                'question': data.get('question'),
-                                'options': data.get('options', []),
-                                'answer': data.get('answer'),
-                                'explanation': data.get('explanation'),
-                                'type': 'listening'
-                            }
-                        else: st.error("データ作成失敗")
-                    except: st.error("エラー発生")
-                
-                else:
-                    # 通常問題用
-                    sub_genre = ""
-                    if train_menu == "証明問題":
-                        sub_genre = random.choice(["合同の証明", "相似の証明", "整数の性質の証明"])
-                        target_menu_name = f"数学の{sub_genre}"
-                    else:
-                        target_menu_name = train_menu
-
-                    p_normal = f"""
-                    公立高校入試レベルの「{target_menu_name}」の問題を1問作成してください。
-                    
-                    【厳守フォーマット】
-                    ===QUESTION===
-                    (問題文のみ)
-                    
-                    ===ANSWER===
-                    (模範解答と解説)
-                    """
-                    res = ask_gemini_robust(p_normal)
-                    question = ""
-                    answer = ""
-                    if "===QUESTION===" in res: question = res.split("===QUESTION===")[1].split("===ANSWER===")[0].strip()
-                    if "===ANSWER===" in res: answer = res.split("===ANSWER===")[1].strip()
-                    if not question: question = res
-                    
-                    st.session_state['practice_data'] = {
-                        'question': question,
-                        'answer': answer,
-                        'type': 'normal',
-                        'sub_genre': sub_genre # 証明の場合のジャンル名保持用
-                    }
-
-        # --- 表示エリア ---
-        p_data = st.session_state['practice_data']
+        if results:
+            table = batch_table(results)
+            done = table[table['状態'] == '完了']
+            st.caption(f"完了 {len(done)}件 / 失敗 {(table['状態'] == '失敗').sum()}件")
+            st.dataframe(table[['ファイル名', '状態', '得点', '満点', '得点率(%)', '要約']],
+                         column_config={"得点率(%)": st.column_config.ProgressColumn(format="%.1f%%", min_value=0, max_value=100)},
+                         use_container_width=True, hide_index=True)
+            st.download_button("⬇️ 結果をCSVで保存", table.drop(columns=['要約']).to_csv(index=False).encode('utf-8-sig'),
+                               f"batch_grading_{today}.csv", "text/csv")
+            detail = st.selectbox("講評を見る", list(results))
+            if detail and results[detail].get('講評'): st.markdown(results[detail]['講評'])
+
+# ------------------
+# TAB 4: その他特訓
+# ------------------
+@traced_fragment("practice_answer")
+def render_practice_answer():
+    # 解答の選択・添削はこの部分だけ再実行する
+    p_data = st.session_state['practice_data']
+    
+    if p_data:
+        st.markdown("---")
+        if p_data.get('sub_genre'):
+            st.caption(f"出題ジャンル: {p_data['sub_genre']}")
+        if p_data.get('source') == "library":
+            st.caption("📚 ライブラリから出題しました")
+
+        # === リスニング形式 ===
+        if p_data.get('type') == 'listening':
+            st.write("🔈 **リスニング音声**")
+            if not audio_cache.synthesizer.available:
+                st.error("⚠️ `gTTS` ライブラリがありません。")
+            else:
+                audio_data = text_to_speech(p_data['script'])
+                if audio_data: st.audio(audio_data, format='audio/mp3')
+
+            st.markdown("#### 📝 問題")
+            st.markdown(p_data.get('question', ''))
+            
+            options = p_data.get('options', [])
+            if options:
+                user_sel = st.radio("解答を選択:", options, key="lis_radio")
+                if st.button("回答する"):
+                    st.markdown("---")
+                    if user_sel == p_data.get('answer'): st.success(f"🙆‍♂️ 正解！ ({user_sel})")
+                    else: st.error(f"🙅‍♂️ 不正解... 正解は「{p_data.get('answer')}」です。")
+                    st.markdown("### 解説")
+                    st.markdown(p_data.get('explanation'))
+                    st.markdown("**スクリプト:**")
+                    st.code(p_data.get('script'))
         
-        if p_data:
+        # === 通常記述形式 ===
+        else:
+            st.markdown("#### 📝 問題")
+            st.markdown(p_data.get('question', ''))
+            
             st.markdown("---")
-            if p_data.get('sub_genre'):
-                st.caption(f"出題ジャンル: {p_data['sub_genre']}")
-
-            # === リスニング形式 ===
-            if p_data.get('type') == 'listening':
-                st.write("🔈 **リスニング音声**")
-                if gTTS is None:
-                    st.error("⚠️ `gTTS` ライブラリがありません。")
-                else:
-                    audio_data = text_to_speech(p_data['script'])
-                    if audio_data: st.audio(audio_data, format='audio/mp3')
-
-                st.markdown("#### 📝 問題")
-                st.markdown(p_data.get('question', ''))
-                
-                options = p_data.get('options', [])
-                if options:
-                    user_sel = st.radio("解答を選択:", options, key="lis_radio")
-                    if st.button("回答する"):
-                        st.markdown("---")
-                        if user_sel == p_data.get('answer'): st.success(f"🙆‍♂️ 正解！ ({user_sel})")
-                        else: st.error(f"🙅‍♂️ 不正解... 正解は「{p_data.get('answer')}」です。")
-                        st.markdown("### 解説")
-                        st.markdown(p_data.get('explanation'))
-                        st.markdown("**スクリプト:**")
-                        st.code(p_data.get('script'))
+            with st.expander("🫣 正解・解説を見る"):
+                st.markdown(p_data.get('answer'))
             
-            # === 通常記述形式 ===
-            else:
-                st.markdown("#### 📝 問題")
-                st.markdown(p_data.get('question', ''))
+            st.markdown("---")
+            st.write("📷 **(記述の場合) 解答をアップロードしてAI添削**")
+            user_ans_img = st.file_uploader("解答の写真をアップロード", type=['jpg', 'png', 'jpeg'], key="practice_up")
+            
+            if user_ans_img and st.button("💯 添削してもらう"):
+                prompt_check = f"""
+                以下の問題と正解データに基づき、生徒の解答画像を厳しめに採点してください。
                 
-                st.markdown("---")
-                with st.expander("🫣 正解・解説を見る"):
-                    st.markdown(p_data.get('answer'))
+                【問題】
+                {p_data.get('question')}
                 
-                st.markdown("---")
-                st.write("📷 **(記述の場合) 解答をアップロードしてAI添削**")
-                user_ans_img = st.file_uploader("解答の写真をアップロード", type=['jpg', 'png', 'jpeg'], key="practice_up")
+                【正解・解説】
+                {p_data.get('answer')}
                 
-                if user_ans_img and st.button("💯 添削してもらう"):
-                    with st.spinner("AI先生が採点中..."):
-                        prompt_check = f"""
-                        以下の問題と正解データに基づき、生徒の解答画像を厳しめに採点してください。
-                        
-                        【問題】
-                        {p_data.get('question')}
-                        
-                        【正解・解説】
-                        {p_data.get('answer')}
-                        
-                        採点結果、添削、改善アドバイスを出力してください。
-                        """
-                        img = PIL.Image.open(user_ans_img)
-                        res_check = ask_gemini_robust(prompt_check, [img])
-                        st.markdown("### 👩‍🏫 添削結果")
-                        st.markdown(res_check)
+                採点結果、添削、改善アドバイスを出力してください。
+                """
+                imgs, original, sent = prepare_images([user_ans_img])
+                st.caption(image_savings_caption(original, sent))
+                st.markdown("### 👩‍🏫 添削結果")
+                p_data['check_result'] = render_gemini(prompt_check, imgs, cache_site="grade", spinner="AI先生が採点中...")
+            elif p_data.get('check_result'):
+                st.markdown("### 👩‍🏫 添削結果")
+                st.markdown(p_data['check_result'])
+
+@traced_fragment("tab4")
+def render_practice_tab():
+    st.subheader("🧩 その他特訓（ランダム出題）")
+    st.caption("公立高校入試レベルの問題をランダムに出題します。")
+    
+    train_menu = st.radio("メニューを選択", PRACTICE_MENUS, horizontal=True)
+    # 選んだメニューの作り置きを裏で始めておく
+    for key in menu_pool_keys(train_menu): problem_pool.refill(key)
+    stock = sum(problem_pool.level(k) for k in menu_pool_keys(train_menu))
+    st.caption(f"⚡ すぐ出せる問題: {stock}問")
+    
+    if st.button("🎲 問題を作成する"):
+        # データリセット
+        st.session_state['practice_data'] = {}
+        sub_genre = ""
+        if train_menu == "証明問題":
+            # 作り置きのあるジャンルから選ぶ (どれも空ならランダム)
+            stocked = [g for g in PROOF_GENRES if problem_pool.level(pool_key(train_menu, g))]
+            sub_genre = random.choice(stocked or PROOF_GENRES)
+        # ライブラリの未出題 → 作り置き → その場で作る の順
+        data = take_practice_from_library(train_menu, sub_genre)
+        if data is None:
+            data = problem_pool.take(pool_key(train_menu, sub_genre))
+            if data is None:
+                # ストックが空なら今まで通りその場で作る
+                with st.spinner("AIが出題中..."):
+                    if train_menu == "リスニング": data = generate_listening_problem()
+                    else: data = generate_normal_problem(train_menu, sub_genre)
+            save_practice_to_library(data, train_menu, sub_genre)
+        # ライブラリから出したリスニングも、表示より先に音声合成を始めておく (同じ文なら二重には作らない)
+        if data and data.get('type') == 'listening': prefetch_speech(data.get('script'))
+        if data: st.session_state['practice_data'] = data
+        else: st.error("データ作成失敗")
 
+    # --- 表示エリア ---
+    render_practice_answer()
+
+if any(len(df) for df in st.session_state['clean_parts'].values()):
+    cube = get_summary_cube()
+    st.markdown("---")
+    
+    tab1, tab2, tab3, tab4 = st.tabs(["📊 全体分析", "📖 復習＆テスト", "📷 画像採点", "🧩 その他特訓"])
+    with tab1: render_analysis_tab(cube)
+    with tab2: render_review_tab(cube)
+    with tab3: render_grading_tab()
+    with tab4: render_practice_tab()
 else:
     st.info("👆 サイドバーからCSVを読み込むか、ファイルをアップロードしてください。")
+
+with tracer.span("student_sync"): sync_student_store()
+if WARM_UP: start_warm_up()
+if tracer.enabled: tracer.record("rerun", time.perf_counter() - run_started, {})
@@ -0,0 +1,500 @@
+# ==========================================
+# ⏱️ 新潟高校 合格ナビ ベンチマーク
+# ==========================================
+# Gemini と gTTS をプロセス内の偽物に差し替え、合成データで各処理の時間を測る。ネットワークもAPIキーも不要。
+#   python bench_juken.py                  # 全部
+#   python bench_juken.py --quick          # 件数を減らして短時間で
+#   python bench_juken.py --only csv,retry --latency 0.2 --failure-rate 0.1
+#   python bench_juken.py --only startup   # 起動時間。予算 (STARTUP_BUDGET) を超えたら終了コード1
+# 結果は1行1計測のJSON (JSON Lines) で --output に書き出す。回帰の追跡用なので項目名は変えないこと。
+import argparse
+import ast
+import importlib.abc
+import importlib.util
+import io
+import json
+import os
+import random
+import re
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import types
+import warnings
+
+APP_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "app_juken.py")
+# app_juken.py のうち、画面を描く前 (関数・クラス定義) までを読み込んで直接呼ぶ
+APP_LIBRARY_END = "# 🖥️ サイドバー"
+FAKE_MODELS = ["gemini-2.5-pro", "gemini-2.5-flash", "gemini-2.0-flash"]
+SUBJECTS = ["国語", "数学", "英語", "理科", "社会"]
+
+# ---------------------------------------------------------
+# 🤖 Gemini / gTTS の偽物
+# ---------------------------------------------------------
+class FakeQuotaError(Exception):
+    pass
+
+class FakeUsage:
+    def __init__(self, prompt, text):
+        self.prompt_token_count = len(prompt) // 2
+        self.candidates_token_count = len(text) // 2
+        self.total_token_count = self.prompt_token_count + self.candidates_token_count
+
+class FakeResponse:
+    def __init__(self, prompt, text, chunks=1):
+        self.text = text
+        self.usage_metadata = FakeUsage(prompt, text)
+        size = max(1, len(text) // chunks)
+        self._chunks = [text[i:i + size] for i in range(0, len(text), size)] or [""]
+
+    def __iter__(self):
+        for c in self._chunks:
+            yield types.SimpleNamespace(text=c, usage_metadata=self.usage_metadata)
+
+class FakeGemini:
+    # generate_content の遅延と 429 の発生率を指定できる。呼び出し回数は数えておく
+    def __init__(self, latency=0.05, failure_rate=0.0, seed=0):
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.categories = {}
+        self.calls = self.failures = 0
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def install(self, genai):
+        genai.configure = lambda **kw: None
+        genai.list_models = lambda: [types.SimpleNamespace(name=f"models/{n}") for n in FAKE_MODELS]
+        genai.GenerativeModel = lambda name, **kw: FakeModel(self, name)
+
+    def call(self, contents, stream, config=None):
+        prompt = contents if isinstance(contents, str) else contents[0]
+        with self._lock:
+            self.calls += 1
+            fail = self._rng.random() < self.failure_rate
+            delay = self._rng.uniform(0.5, 1.5) * self.latency
+            if fail: self.failures += 1
+        time.sleep(delay)
+        if fail: raise FakeQuotaError("429 Resource has been exhausted (e.g. check quota).")
+        return FakeResponse(prompt, self.respond(prompt, config), chunks=4 if stream else 1)
+
+    def respond(self, prompt, config=None):
+        # config: generation_config。response_schema があればその形のJSONで返す
+        schema = (config or {}).get("response_schema")
+        if "「教科:単元」を分析" in prompt:
+            m = re.search(r'入力: (\[.*\])', prompt, re.DOTALL)
+            inputs = ast.literal_eval(m.group(1)) if m else []
+            out = []
+            for item in inputs:
+                subj = item.split(':', 1)[0].strip()
+                cats = self.categories.get(subj) or ["その他"]
+                out.append({"input": item, "category": cats[sum(map(ord, item)) % len(cats)]})
+            return json.dumps({"items": out}, ensure_ascii=False)
+        if schema and "指摘された項目だけを直し" in prompt:
+            return json.dumps({k: "修正済み" for k in schema["required"]}, ensure_ascii=False)
+        if "リスニング問題" in prompt:
+            return json.dumps({"script": "A: Where are you going? B: To the library.", "question": "Bはどこへ行きますか。",
+                               "options": ["図書館", "駅", "学校", "公園"], "answer": "図書館", "explanation": "library=図書館"}, ensure_ascii=False)
+        if schema and "question" in schema["properties"]:
+            return json.dumps({"question": "次の式を因数分解しなさい。 x^2-5x+6", "answer": "(x-2)(x-3)"}, ensure_ascii=False)
+        if "採点" in prompt:
+            return "よく書けています。途中式を丁寧に。\nSCORE: 7/10"
+        return "まずは基本問題を繰り返し、間違えた問題をノートにまとめましょう。" * 3
+
+class FakeModel:
+    def __init__(self, gemini, name):
+        self.gemini = gemini
+        self.model_name = name
+
+    def generate_content(self, contents, stream=False, generation_config=None, **kw):
+        return self.gemini.call(contents, stream, generation_config)
+
+def install_fake_tts(latency):
+    # gtts が無い環境でも動くよう、モジュールごと差し替える
+    class FakeGTTS:
+        def __init__(self, text, lang="en", **kw): self.text = text
+        def write_to_fp(self, fp):
+            time.sleep(latency)
+            fp.write(b"ID3" + self.text.encode("utf-8"))
+    sys.modules["gtts"] = types.SimpleNamespace(gTTS=FakeGTTS)
+
+# ---------------------------------------------------------
+# 🧪 合成データ
+# ---------------------------------------------------------
+def make_csv_bytes(rng, name, categories, n_questions=12, unknown=()):
+    # 実際の模試CSVと同じく、1行目にタイトル、以降は「項目名,値,値,...」の横持ち
+    subj = next((s for s in SUBJECTS if s in name), "数学")
+    units = [rng.choice(categories[subj]) for _ in range(n_questions)]
+    for i, u in enumerate(unknown): units[i % n_questions] = u
+    full = [rng.choice([5, 10, 20]) for _ in units]
+    rows = [
+        [f"{name} 結果", ""],
+        ["大問"] + [str(i // 3 + 1) for i in range(len(units))],
+        ["内容"] + units,
+        ["配点"] + [str(v) for v in full],
+        ["点数"] + [str(rng.randint(0, v)) for v in full],
+        ["反省"] + [rng.choice(["", "計算ミス", "時間不足"]) for _ in units],
+    ]
+    text = "\r\n".join(",".join(r) for r in rows) + "\r\n"
+    return text.encode(rng.choice(["utf-8", "utf-8-sig", "cp932"]))
+
+class NamedBytes(io.BytesIO):
+    def __init__(self, raw, name):
+        super().__init__(raw)
+        self.name = name
+
+def make_store(app, rng, n_files, unknown_per_file=0, tag=""):
+    store = {}
+    for i in range(n_files):
+        name = f"{SUBJECTS[i % len(SUBJECTS)]}_{tag}{i:04d}.csv"
+        unknown = [f"発展テーマ{tag}{i}-{j}" for j in range(unknown_per_file)]
+        raw = make_csv_bytes(rng, name, app['FIXED_CATEGORIES'], unknown=unknown)
+        store[app['content_hash'](raw, name)] = app['parse_csv_bytes'](raw, name)
+    return store
+
+# ---------------------------------------------------------
+# 📏 計測
+# ---------------------------------------------------------
+def timings(values):
+    values = sorted(values)
+    return {'n': len(values), 'min_ms': round(values[0] * 1000, 2), 'median_ms': round(statistics.median(values) * 1000, 2),
+            'p95_ms': round(values[min(len(values) - 1, int(len(values) * 0.95))] * 1000, 2)}
+
+class QuietWidget:
+    # ベアモードでは st.status などが None を返すので、その代わりに何もしない部品を返す
+    def __enter__(self): return self
+    def __exit__(self, *exc): return False
+    def __getattr__(self, name): return lambda *a, **kw: self
+
+class QuietStreamlit:
+    def __init__(self, st): self._st = st
+    def __getattr__(self, name): return getattr(self._st, name)
+    def status(self, *a, **kw): return QuietWidget()
+    def progress(self, *a, **kw): return QuietWidget()
+    def dataframe(self, *a, **kw): return None
+
+def load_app(fake):
+    # 画面部分を除いたアプリ本体を、Streamlitのベアモードで読み込む
+    import streamlit as st
+    from streamlit import config, logger
+    config.get_option("logger.level")   # 設定ファイルを先に読ませてから黙らせる
+    logger.set_log_level("error")
+    st.secrets = {"GEMINI_API_KEY": "bench"}
+    src = open(APP_PATH, encoding="utf-8").read()
+    app = {'__name__': 'app_juken_bench', '__file__': os.path.abspath(APP_PATH)}
+    exec(compile(src[:src.index(APP_LIBRARY_END)], APP_PATH, "exec"), app)
+    app['st'] = QuietStreamlit(st)
+    fake.categories = app['FIXED_CATEGORIES']
+    return app
+
+def reset_session(app, store=None):
+    st = app['st']
+    st.session_state['data_store'] = store or {}
+    st.session_state['category_map'] = {}
+    st.session_state['textbooks'] = {}
+    app['reset_analysis']()
+
+def bench_reruns(args, fake, app):
+    # AppTest でスクリプト全体を再実行する時間。タブごとに、そのタブの操作で起きる再実行を測る
+    from streamlit.testing.v1 import AppTest
+    rng = random.Random(args.seed)
+    at = AppTest.from_file(APP_PATH, default_timeout=120)
+    at.secrets["GEMINI_API_KEY"] = "bench"
+    at.run()
+    at.session_state['data_store'] = make_store(app, rng, args.files)
+    at.run()
+    next(b for b in at.button if 'AI解析' in b.label).click().run()
+
+    def button(label): return lambda: next(b for b in at.button if label in b.label).click().run()
+    def choose(widgets, label, values):
+        cycle = iter(values * args.repeat * 2)
+        return lambda: next(w for w in widgets() if w.label == label).set_value(next(cycle)).run()
+    cases = [
+        ("idle", lambda: at.run()),
+        ("tab1_reanalyze", button("AI解析")),
+        ("tab2_subject", choose(lambda: at.selectbox, "教科", ["英語", "数学"])),
+        ("tab2_advice", button("アドバイス")),
+        ("tab3_grade_mode", choose(lambda: at.radio, "採点方法", ["まとめて採点", "1枚ずつ"])),
+        ("tab4_generate", button("問題を作成")),
+    ]
+    records = []
+    for case, action in cases:
+        samples = []
+        calls = fake.calls
+        for _ in range(args.repeat):
+            start = time.perf_counter()
+            action()
+            samples.append(time.perf_counter() - start)
+            if at.exception: raise RuntimeError(f"{case}: {at.exception}")
+        records.append({'bench': 'rerun', 'case': case, 'files': args.files, 'gemini_calls': fake.calls - calls, **timings(samples)})
+    return records
+
+def bench_csv(args, fake, app):
+    rng = random.Random(args.seed)
+    blobs = [(f"{SUBJECTS[i % 5]}_{i:05d}.csv", make_csv_bytes(rng, f"{SUBJECTS[i % 5]}_{i:05d}.csv", app['FIXED_CATEGORIES'])) for i in range(args.csv_files)]
+    total_bytes = sum(len(raw) for _, raw in blobs)
+    start = time.perf_counter()
+    for name, raw in blobs: app['parse_csv_bytes'](raw, name)
+    serial = time.perf_counter() - start
+    files = [NamedBytes(raw, name) for name, raw in blobs]
+    start = time.perf_counter()
+    frames, errors, _ = app['parse_csv_files'](files)
+    batch = time.perf_counter() - start
+    start = time.perf_counter()
+    _, _, skipped = app['parse_csv_files'](files, known=set(frames))
+    known = time.perf_counter() - start
+    common = {'bench': 'parse_csv', 'files': len(blobs), 'bytes': total_bytes}
+    return [
+        {**common, 'case': 'serial', 'seconds': round(serial, 3), 'files_per_s': round(len(blobs) / serial, 1), 'mb_per_s': round(total_bytes / serial / 1e6, 2)},
+        {**common, 'case': 'parse_csv_files', 'seconds': round(batch, 3), 'files_per_s': round(len(blobs) / batch, 1), 'errors': len(errors)},
+        {**common, 'case': 'already_known', 'seconds': round(known, 3), 'skipped': skipped},
+    ]
+
+def bench_categorize(args, fake, app):
+    # 未知の単元数に対する process_and_categorize の所要時間 (応答キャッシュに当たらないよう毎回別の単元名にする)
+    records = []
+    rng = random.Random(args.seed)
+    for n_unknown in args.unknown:
+        tag = f"{n_unknown}x{rng.randrange(10 ** 6)}-"
+        per_file = max(1, -(-n_unknown // args.files)) if n_unknown else 0
+        store = make_store(app, rng, args.files, per_file, tag)
+        reset_session(app, store)
+        calls = fake.calls
+        start = time.perf_counter()
+        app['process_and_categorize']()
+        elapsed = time.perf_counter() - start
+        st = app['st']
+        records.append({'bench': 'categorize', 'case': f"unknown_{n_unknown}", 'files': args.files, 'unknown_units': per_file * args.files if n_unknown else 0,
+                        'seconds': round(elapsed, 3), 'gemini_calls': fake.calls - calls,
+                        'unresolved': len(st.session_state['unresolved_pairs']), 'rows': sum(len(df) for df in st.session_state['clean_parts'].values())})
+    return records
+
+def bench_backup(args, fake, app):
+    st = app['st']
+    records = []
+    rng = random.Random(args.seed)
+    for n_files in args.backup_files:
+        reset_session(app, make_store(app, rng, n_files))
+        start = time.perf_counter()
+        full = app['make_backup']('full')
+        encode = time.perf_counter() - start
+        start = time.perf_counter()
+        snap = app['load_backup'](full['data'])
+        decode = time.perf_counter() - start
+        # 比較用: 旧形式 (JSON→gzip→base64)
+        import gzip, base64
+        legacy = base64.b64encode(gzip.compress(json.dumps({'data_store': {k: df.to_json(orient='split') for k, df in st.session_state['data_store'].items()}}).encode('utf-8')))
+        records.append({'bench': 'backup', 'case': f"full_{n_files}", 'files': n_files, 'bytes': len(full['data']), 'legacy_bytes': len(legacy),
+                        'encode_ms': round(encode * 1000, 2), 'decode_ms': round(decode * 1000, 2), 'roundtrip_ok': len(snap['data_store']) == n_files})
+    return records
+
+class RetryRegistry:
+    def __init__(self, fake): self.fake = fake
+    def model_name(self, role): return FAKE_MODELS[1] if role == "flash" else FAKE_MODELS[0]
+    def model(self, role): return FakeModel(self.fake, self.model_name(role))
+
+def bench_retry(args, fake, app):
+    # 429 の再試行。バックオフは --backoff-scale 倍に縮めて測り、予定した待ち時間の合計も記録する
+    app['BACKOFF_BASE'] = 2.0 * args.backoff_scale
+    app['BACKOFF_CAP'] = 60.0 * args.backoff_scale
+    app['RATE_LIMITS'] = {"pro": (10 ** 6, 10 ** 6), "flash": (10 ** 6, 10 ** 6)}
+    records = []
+    for rate in args.retry_failure_rates:
+        local = FakeGemini(latency=args.latency, failure_rate=rate, seed=args.seed)
+        client = app['GeminiClient'](RetryRegistry(local))
+        ok = quota = 0
+        start = time.perf_counter()
+        def one(i):
+            nonlocal ok, quota
+            try:
+                client.generate("pro", f"bench retry {i}")
+                ok += 1
+            except app['GeminiQuotaError']: quota += 1
+        threads = [threading.Thread(target=one, args=(i,)) for i in range(args.retry_requests)]
+        for t in threads: t.start()
+        for t in threads: t.join()
+        elapsed = time.perf_counter() - start
+        stats = client.stats()
+        records.append({'bench': 'retry_429', 'case': f"failure_{rate}", 'requests': args.retry_requests, 'succeeded': ok, 'gave_up': quota,
+                        'attempts': local.calls, 'retries': stats['retries'], 'seconds': round(elapsed, 3), 'backoff_scale': args.backoff_scale})
+    return records
+
+# ---------------------------------------------------------
+# 🚀 起動時間
+# ---------------------------------------------------------
+# 新しいプロセスでの最初の表示 (AppTest の最初の run) にかけてよい時間(秒)。超えたら回帰として終了コード1
+STARTUP_BUDGET = float(os.environ.get("JUKEN_STARTUP_BUDGET", "1.5"))
+# 最初の表示までに読み込まれてはいけない重いモジュール (使う時か、表示後の warm_up で読む)
+STARTUP_LAZY_MODULES = ["pandas", "numpy", "google.generativeai", "PIL.Image", "gtts", "matplotlib"]
+STARTUP_TOP_IMPORTS = 8
+
+class PatchOnImport(importlib.abc.MetaPathFinder):
+    # 指定したモジュールが読み込まれた直後に偽物を差し込む。読み込み自体の時間も測りたいので先に import しない
+    def __init__(self, name, patch):
+        self.name, self.patch = name, patch
+
+    def find_spec(self, fullname, path, target=None):
+        if fullname != self.name: return None
+        sys.meta_path.remove(self)
+        spec = importlib.util.find_spec(fullname)
+        exec_module = spec.loader.exec_module
+        def patched(module):
+            exec_module(module)
+            self.patch(module)
+        spec.loader.exec_module = patched
+        return spec
+
+class ImportRecorder(importlib.abc.MetaPathFinder):
+    # 見張るモジュールが、いつ・どのスレッドで実際に読み込まれたかを記録する。
+    # find_spec だけ (入っているかの確認) では数えないよう、モジュールの実行時に記録する
+    def __init__(self, names):
+        self.names = set(names)
+        self.seen = {}
+        self._local = threading.local()
+
+    def find_spec(self, fullname, path, target=None):
+        if fullname not in self.names or getattr(self._local, 'busy', False): return None
+        self._local.busy = True
+        try: spec = importlib.util.find_spec(fullname)
+        finally: self._local.busy = False
+        if spec is None or spec.loader is None: return spec
+        exec_module = spec.loader.exec_module
+        def recorded(module):
+            self.seen.setdefault(fullname, (time.perf_counter(), threading.current_thread().name))
+            exec_module(module)
+        spec.loader.exec_module = recorded
+        return spec
+
+def startup_child(args):
+    # --startup-child: 計測用の子プロセス側。結果を1行のJSONで標準出力に書く
+    fake = FakeGemini(args.latency, 0.0, args.seed)
+    def install(genai):
+        fake.install(genai)
+        names = genai.list_models
+        genai.list_models = lambda: (time.sleep(args.model_list_latency), names())[1]
+    sys.meta_path.insert(0, PatchOnImport("google.generativeai", install))
+    recorder = ImportRecorder(STARTUP_LAZY_MODULES)
+    sys.meta_path.insert(0, recorder)
+    warnings.simplefilter("ignore", FutureWarning)
+    start = time.perf_counter()
+    from streamlit.testing.v1 import AppTest
+    from streamlit import config, logger
+    config.get_option("logger.level")
+    logger.set_log_level("error")
+    import_s = time.perf_counter() - start
+    at = AppTest.from_file(APP_PATH, default_timeout=120)
+    at.secrets["GEMINI_API_KEY"] = "bench"
+    start = time.perf_counter()
+    at.run()
+    first_end = time.perf_counter()
+    first_s = first_end - start
+    if at.exception: raise RuntimeError(f"startup: {at.exception}")
+    # warm_up スレッドが読んだものは数えない
+    eager = [m for m, (t, thread) in recorder.seen.items() if t <= first_end and thread != "warm-up"]
+    start = time.perf_counter()
+    at.run()
+    rerun_s = time.perf_counter() - start
+    # 表示後の準備 (warm_up スレッド) が終わるまでの時間。無効なら 0
+    start = time.perf_counter()
+    for t in threading.enumerate():
+        if t.name == "warm-up": t.join(timeout=60)
+    warm_s = time.perf_counter() - start
+    print(json.dumps({'streamlit_import_s': import_s, 'first_run_s': first_s, 'rerun_s': rerun_s, 'warm_up_wait_s': warm_s,
+                      'eager_modules': sorted(eager), 'warmed_modules': sorted(m for m, (_, thread) in recorder.seen.items() if thread == "warm-up")}))
+
+def top_imports(importtime_log, n=STARTUP_TOP_IMPORTS):
+    # python -X importtime の出力から、直接 import されたモジュール (字下げなし) を累積時間の長い順に
+    top = {}
+    for line in importtime_log.splitlines():
+        m = re.match(r'import time:\s+\d+ \|\s+(\d+) \| (\S.*)$', line)
+        if m: top[m.group(2)] = int(m.group(1)) / 1000
+    return {k: round(v, 1) for k, v in sorted(top.items(), key=lambda kv: -kv[1])[:n]}
+
+def bench_startup(args, fake, app):
+    # 毎回新しいプロセスで起動し、最初の表示までの時間・読み込まれたモジュール・import の内訳 (ms) を記録する
+    samples, rerun, warm, eager, imports = [], [], [], set(), {}
+    for i in range(args.startup_runs):
+        cmd = [sys.executable, "-X", "importtime", os.path.abspath(__file__), "--startup-child",
+               "--latency", str(args.latency), "--model-list-latency", str(args.model_list_latency), "--seed", str(args.seed + i)]
+        proc = subprocess.run(cmd, capture_output=True, text=True, env=dict(os.environ), timeout=300)
+        if proc.returncode: raise RuntimeError(f"startup: 子プロセスが失敗しました\n{proc.stderr[-2000:]}")
+        res = json.loads(proc.stdout.strip().splitlines()[-1])
+        samples.append(res['first_run_s'])
+        rerun.append(res['rerun_s'])
+        warm.append(res['warm_up_wait_s'])
+        eager.update(res['eager_modules'])
+        if not imports: imports = top_imports(proc.stderr)
+    first = timings(samples)
+    return [{'bench': 'startup', 'case': 'cold', 'model_list_latency': args.model_list_latency, **first,
+             'rerun_median_ms': timings(rerun)['median_ms'], 'warm_up_wait_median_ms': timings(warm)['median_ms'],
+             'eager_modules': sorted(eager), 'top_imports_ms': imports,
+             'budget_ms': STARTUP_BUDGET * 1000, 'over_budget': first['median_ms'] > STARTUP_BUDGET * 1000 or bool(eager)}]
+
+BENCHES = {'rerun': bench_reruns, 'csv': bench_csv, 'categorize': bench_categorize, 'backup': bench_backup, 'retry': bench_retry, 'startup': bench_startup}
+
+def git_revision():
+    try: return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=os.path.dirname(APP_PATH), capture_output=True, text=True).stdout.strip() or None
+    except Exception: return None
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description="新潟高校 合格ナビ のベンチマーク (Gemini/gTTS は偽物)")
+    ap.add_argument("--only", default=",".join(BENCHES), help=f"実行するベンチ (カンマ区切り: {','.join(BENCHES)})")
+    ap.add_argument("--quick", action="store_true", help="件数を減らして短時間で回す")
+    ap.add_argument("--latency", type=float, default=0.05, help="偽Geminiの平均応答時間(秒)")
+    ap.add_argument("--failure-rate", type=float, default=0.0, help="偽Geminiが429を返す確率")
+    ap.add_argument("--tts-latency", type=float, default=0.02, help="偽gTTSの合成時間(秒)")
+    ap.add_argument("--backoff-scale", type=float, default=0.01, help="429再試行ベンチでのバックオフ時間の倍率")
+    ap.add_argument("--seed", type=int, default=0)
+    ap.add_argument("--output", default="bench_output.txt", help="結果(JSON Lines)の出力先。'-' で標準出力")
+    ap.add_argument("--model-list-latency", type=float, default=1.0, help="起動ベンチでのモデル一覧取得の時間(秒)")
+    ap.add_argument("--startup-child", action="store_true", help=argparse.SUPPRESS)
+    args = ap.parse_args(argv)
+    if args.startup_child: return startup_child(args)
+    args.repeat = 3 if args.quick else 10
+    args.files = 10 if args.quick else 40
+    args.csv_files = 300 if args.quick else 3000
+    args.unknown = [0, 20, 80] if args.quick else [0, 20, 80, 200, 400]
+    args.backup_files = [10, 100] if args.quick else [10, 100, 1000]
+    args.retry_failure_rates = [0.0, 0.3, 0.6] if args.quick else [0.0, 0.1, 0.3, 0.6, 0.9]
+    args.retry_requests = 10 if args.quick else 40
+    args.startup_runs = 3 if args.quick else 5
+
+    # アプリを読み込む前に、キャッシュ先を一時ディレクトリにし、レート制限は実測の邪魔をしないよう緩める
+    cache_dir = tempfile.mkdtemp(prefix="juken_bench_")
+    os.environ["JUKEN_CACHE_DIR"] = cache_dir
+    os.environ.setdefault("JUKEN_RPM_PRO", "100000")
+    os.environ.setdefault("JUKEN_RPM_FLASH", "100000")
+    warnings.simplefilter("ignore", FutureWarning)
+    import google.generativeai as genai
+    from streamlit import logger
+    fake = FakeGemini(args.latency, args.failure_rate, args.seed)
+    fake.install(genai)
+    install_fake_tts(args.tts_latency)
+
+    meta = {'revision': git_revision(), 'timestamp': time.strftime("%Y-%m-%dT%H:%M:%S"), 'python': sys.version.split()[0],
+            'latency': args.latency, 'failure_rate': args.failure_rate, 'quick': args.quick}
+    out = sys.stdout if args.output == "-" else open(args.output, "w", encoding="utf-8")
+    over_budget = []
+    try:
+        app = load_app(fake)
+        for name in [n.strip() for n in args.only.split(",") if n.strip()]:
+            if name not in BENCHES: ap.error(f"不明なベンチ: {name}")
+            logger.set_log_level("error")   # AppTest が設定を読み直すと元に戻るので毎回
+            start = time.perf_counter()
+            for rec in BENCHES[name](args, fake, app):
+                out.write(json.dumps({**meta, **rec}, ensure_ascii=False) + "\n")
+                out.flush()
+                if rec.get('over_budget'): over_budget.append(rec)
+            print(f"{name}: {time.perf_counter() - start:.1f}s", file=sys.stderr)
+    finally:
+        if out is not sys.stdout: out.close()
+        shutil.rmtree(cache_dir, ignore_errors=True)
+    for rec in over_budget:
+        print(f"⚠️ 予算超過 [{rec['bench']}/{rec['case']}]: 中央値 {rec['median_ms']:.0f}ms (予算 {rec['budget_ms']:.0f}ms) / 先に読み込まれたモジュール {rec['eager_modules']}", file=sys.stderr)
+    return 1 if over_budget else 0
+
+if __name__ == "__main__":
+    sys.exit(main())